@@ -18,13 +18,21 @@ app.conf.beat_schedule = {
     },
     "timeout-health-checks": {
         "task": "health.tasks.timeout",
-        "schedule": 60 * 60,  # Every hour.
-        "args": (6,),  # Timeout health check results older than 6 hours.
+        "schedule": 60 * 60,  # Every hour, for results older than CHECKS_TIMEOUT_HOURS.
     },
     "get-organisations-from-github": {
         "task": "services.tasks.refresh_orgs_from_github",
         "schedule": 60 * 60,  # Every hour.
     },
+    "process-github-webhooks": {
+        "task": "gh.tasks.process_webhooks",
+        "schedule": 60 * 5,  # Every 5 minutes, for any deliveries that weren't queued.
+    },
+    "truncate-webhooks": {
+        "task": "gh.tasks.truncate_webhooks",
+        "schedule": 60 * 60 * 24,  # Every 24 hours.
+        "args": (30,),  # Truncate webhook deliveries older than 30 days.
+    },
     "truncate-logs": {
         "task": "systemlogs.tasks.truncate",
         "schedule": 60 * 60 * 24,  # Every 24 hours.
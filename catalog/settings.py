@@ -42,13 +42,19 @@ CACHES = {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
     }
 }
+# A shared cache lets the workers reuse what each other fetched from GitHub.
+if os.environ.get("CACHE_URL"):
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ.get("CACHE_URL"),
+    }
 CATALOG_ENV = env
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
 CELERY_TASK_RESULT_EXPIRES = 18000  # 5 hours
 
 # Default timeout 6 hours.
-CHECKS_TIMEOUT_HOURS = os.environ.get("CHECKS_TIMEOUT_HOURS", 6)
+CHECKS_TIMEOUT_HOURS = int(os.environ.get("CHECKS_TIMEOUT_HOURS", 6))
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 DEBUG = os.environ.get("DEBUG")
@@ -58,6 +64,8 @@ DATABASES = {"default": dj_database_url.config(conn_max_age=600, conn_health_che
 
 GITHUB_CHECK_REPOSITORY = os.environ.get("GITHUB_CHECK_REPOSITORY", None)
 GITHUB_DEBUG = False
+# How many files to fetch from GitHub at once for each source.
+GITHUB_FETCH_WORKERS = int(os.environ.get("GITHUB_FETCH_WORKERS", 8))
 GOOGLE_FONTS = ["Lato:wght@100;300;400;700"]
 
 INSTALLED_APPS = [
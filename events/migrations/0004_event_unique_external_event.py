@@ -0,0 +1,56 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+
+def dedupe(apps, schema_editor):
+    """
+    Merge events with the same source, external ID and name into the first one, such as
+    the ones added when a webhook was sent more than once.
+    """
+    Event = apps.get_model("events", "Event")
+    Through = Event.services.through
+
+    first = {}
+    duplicates = {}
+    events = (
+        Event.objects.exclude(source=None)
+        .exclude(external_id=None)
+        .order_by("pk")
+        .values_list("pk", "source", "external_id", "name")
+    )
+    for pk, *key in events.iterator():
+        key = tuple(key)
+        if key in first:
+            duplicates[pk] = first[key]
+        else:
+            first[key] = pk
+
+    if not duplicates:
+        return
+
+    links = Through.objects.filter(event_id__in=list(duplicates)).values_list(
+        "event_id", "service_id"
+    )
+    Through.objects.bulk_create(
+        [Through(event_id=duplicates[event], service_id=service) for event, service in links],
+        ignore_conflicts=True,
+    )
+    Event.objects.filter(pk__in=list(duplicates)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0003_alter_event_status_alter_event_url"),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="event",
+            constraint=models.UniqueConstraint(
+                fields=("source", "external_id", "name"), name="unique_external_event"
+            ),
+        ),
+    ]
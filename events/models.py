@@ -65,6 +65,16 @@ class Event(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            # So that the same event from an external source, such as a webhook that has been
+            # sent again, updates the event rather than adding another one. There can be an
+            # event per service for the same external ID, each with its own name.
+            models.UniqueConstraint(
+                fields=["source", "external_id", "name"], name="unique_external_event"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.type}"
 
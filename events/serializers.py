@@ -2,9 +2,24 @@ from rest_framework import serializers
 
 from .models import Event
 
+unique_fields = ["source", "external_id", "name"]
+
 
 class EventSerializer(serializers.ModelSerializer):
     class Meta:
         model = Event
         fields = "__all__"
         read_only_fields = ["slug"]
+
+    def validate(self, data):
+        # Checked here, as the serializer doesn't check unique constraints itself.
+        key = {name: data.get(name, getattr(self.instance, name, None)) for name in unique_fields}
+        if key["source"] is not None and key["external_id"] is not None:
+            existing = Event.objects.filter(**key)
+            if self.instance is not None:
+                existing = existing.exclude(pk=self.instance.pk)
+            if existing.exists():
+                raise serializers.ValidationError(
+                    "An event with this source, external ID and name already exists."
+                )
+        return data
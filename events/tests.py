@@ -152,6 +152,17 @@ class TestEventList(WithEvents):
         self.assertEqual(res.status_code, 201)
         self.assertEqual(Event.objects.count(), 1)
 
+    def test_create_api_duplicate(self):
+        """Test that an event with the same source, external ID and name is rejected"""
+        url = reverse("events:api-events-list")
+        self.api_login()
+        self.add_to_members()
+        data = self.get_event_data()
+        self.assertEqual(self.api_client.post(url, data=data).status_code, 201)
+        res = self.api_client.post(url, data=data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Event.objects.count(), 1)
+
     def test_update_api(self):
         """Test that we can update via the API"""
         event = self.create_event()
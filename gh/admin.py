@@ -0,0 +1,10 @@
+from django.contrib import admin
+
+from .models import WebhookDelivery
+
+
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    pass
+
+
+admin.site.register(WebhookDelivery, WebhookDeliveryAdmin)
@@ -1,6 +1,7 @@
 from django.core.exceptions import ImproperlyConfigured
 
-from .user import login_as_app, login_as_installation
+from .fetch import get_installations, scan_installations
+from .user import login_as_app
 
 
 def get_details():
@@ -27,10 +28,7 @@ def get_orgs():
     except ImproperlyConfigured:
         return []
 
-    orgs = []
-    for installation in gh.get_installations():
-        if installation.target_type == "Organization":
-            gh_installation = login_as_installation(gh, installation)
-            org = gh_installation.get_organization(installation.raw_data["account"]["login"])
-            orgs.append(org)
-    return orgs
+    def get_org(installation, gh_installation):
+        return gh_installation.get_organization(installation.raw_data["account"]["login"])
+
+    return list(scan_installations(gh, get_installations(gh).values(), get_org))
@@ -1,12 +1,25 @@
+import base64
+import json as stdlib_json
 import logging
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from urllib.parse import quote, urlparse
 
 import json5 as json
+from django.conf import settings
+from django.core.cache import cache
 from github import GithubException, UnknownObjectException
+from github.Repository import Repository
 
 from catalog.errors import NoEntryFound, NoRepository, SchemaError
 
-from .user import login_as_app, login_as_installation
+from . import limits, metrics
+from .user import (
+    forget_installation_token,
+    login_as_app,
+    login_as_installation,
+    login_as_installation_id,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -17,20 +30,67 @@ file_paths = [
     ".github/catalog.json",
 ]
 
+# How long to remember which installation has access to a repository.
+repo_timeout = 60 * 5
 
-def get_contents(repo, path):
+# How long to keep a fetched file, it will be checked against GitHub before it's used.
+contents_timeout = 60 * 60 * 24 * 7
+
+
+def get_contents(repo, path, sha=None):
     """
     Actually get the file contents.
+
+    The parsed contents are cached along with the ETag and SHA of the file. When the file
+    is in the cache a conditional request is made, if the file has not changed then
+    GitHub returns a 304, which does not count against the rate limit, and the file
+    does not need to be downloaded or parsed again. If the SHA of the file is already
+    known, from the tree of the repository, and matches, no request is made at all.
     """
-    return json.loads(repo.get_contents(path).decoded_content.decode("utf-8"))
+    key = f"gh:contents:{repo.full_name}:{quote(path)}"
+    cached = cache.get(key)
+    if cached and sha and cached["sha"] == sha:
+        return cached["contents"]
+
+    if cached:
+        url = f"{repo.url}/contents/{quote(path)}"
+        status, headers, body = repo._requester.requestJson(
+            "GET", url, headers={"If-None-Match": cached["etag"]}
+        )
+        if status == 304:
+            return cached["contents"]
+
+        if status == 200:
+            data = stdlib_json.loads(body)
+            if data.get("sha") == cached["sha"]:
+                contents = cached["contents"]
+            else:
+                contents = json.loads(base64.b64decode(data["content"]).decode("utf-8"))
+            set_cached_contents(key, headers.get("etag"), data.get("sha"), contents)
+            return contents
+
+        cache.delete(key)
+
+    # Either not cached yet, or something went wrong with the conditional request, in which
+    # case this raises the right exception.
+    file = repo.get_contents(path)
+    contents = json.loads(file.decoded_content.decode("utf-8"))
+    set_cached_contents(key, file.etag, file.sha, contents)
+    return contents
+
 
+def set_cached_contents(key, etag, sha, contents):
+    if not isinstance(etag, str):
+        return
+    cache.set(key, {"etag": etag, "sha": sha, "contents": contents}, contents_timeout)
 
-def get_file(repo, path):
+
+def get_file(repo, path, sha=None):
     """
     Get a file from a single path.
     """
     try:
-        return {"path": path, "contents": get_contents(repo, path)}
+        return {"path": path, "contents": get_contents(repo, path, sha=sha)}
     except UnknownObjectException:
         logger.info(f"File not found: {path} from: {repo.full_name}")
         raise
@@ -41,13 +101,44 @@ def get_file(repo, path):
         raise SchemaError(f"Unable to decode the JSON in: `{repo.full_name}`.")
 
 
-def get_file_from_list(repo, paths):
+def get_tree(repo):
+    """
+    Get the path and SHA of every file in the default branch of the repository, in one
+    request. Returns None if the tree can't be used, for example if it is too large for
+    GitHub to return in one go.
+    """
+    try:
+        tree = repo.get_git_tree(repo.default_branch, recursive=True)
+    except GithubException:
+        logger.info(f"Unable to get the tree for: {repo.full_name}")
+        return None
+
+    if tree.truncated:
+        return None
+
+    return {element.path: element.sha for element in tree.tree if element.type == "blob"}
+
+
+def get_file_from_list(repo, paths, tree=None):
     """
     Get a file from a list of possible paths, useful for the first lookup.
+
+    If the tree of the repository is available the file is picked from it, otherwise each
+    path is tried in turn.
     """
-    for path in paths:
+    if tree is None:
+        tree = get_tree(repo)
+
+    candidates = paths
+    if tree is not None:
+        candidates = [path for path in paths if path in tree]
+        if len(candidates) > 1:
+            nice_paths = ", ".join([f"`{p}`" for p in candidates])
+            logger.info(f"More than one catalog file in: {repo.full_name}: {nice_paths}")
+
+    for path in candidates:
         try:
-            return get_file(repo, path)
+            return get_file(repo, path, sha=tree.get(path) if tree else None)
         except (UnknownObjectException, GithubException):
             # This means the file is not found in the repo and we go onto the next one.
             continue
@@ -99,26 +190,68 @@ def get_repo(gh, repo):
 
 
 def get(source):
-    organization, repo = url_to_nwo(source.url)
-    repo = get_repo_installation(organization, repo)
+    organization, repo_name = url_to_nwo(source.url)
+    with forget_on_error(organization, repo_name):
+        repo = get_repo_installation(organization, repo_name)
+        try:
+            return get_files(repo, lambda: get_repo_installation(organization, repo_name))
+        finally:
+            limits.record(organization, repo._requester)
+
 
-    results = []
-    already_fetched = []
+def get_files(repo, open_repo=None):
+    """
+    Get the catalog file from the repository and all the files it refers to.
 
-    def recursive_get_files(paths):
-        for file in paths:
-            # Try and prevent recursion, just silently skip.
-            if file in already_fetched:
+    If `open_repo` is passed, it is called to get more clients for the repository and the
+    files are fetched with them at once. The connection of a client can't be shared
+    between threads, so each thread gets its own. Otherwise the files are fetched one by
+    one.
+    """
+    tree = get_tree(repo)
+
+    @metrics.bind
+    def fetch_files(args):
+        client, paths = args
+        return [get_file(client, path, sha=tree.get(path) if tree else None) for path in paths]
+
+    # Fetch the files a level at a time, with all the files in a level fetched at once.
+    first = get_file_from_list(repo, file_paths, tree=tree)
+    fetched = {first["path"]: first}
+    level = [first]
+    clients = [repo]
+    max_workers = settings.GITHUB_FETCH_WORKERS if open_repo else 1
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while level:
+            paths = {}
+            for result in level:
+                for path in result["contents"].get("files", []):
+                    # Try and prevent recursion, just silently skip.
+                    if path not in fetched:
+                        paths[path] = None
+            paths = list(paths)
+
+            # The clients are opened here, rather than in the threads, for the same reason.
+            workers = min(len(paths), max_workers)
+            while len(clients) < workers:
+                clients.append(open_repo())
+            work = [(clients[index], paths[index::workers]) for index in range(workers)]
+            level = [result for results in pool.map(fetch_files, work) for result in results]
+            fetched.update({result["path"]: result for result in level})
+
+    # Return the files in the same order as they appear in the catalog, depth first.
+    results = [first]
+    visited = {first["path"]}
+
+    def add_files(paths):
+        for path in paths:
+            if path in visited:
                 continue
-            already_fetched.append(file)
-            result = get_file(repo, file)
-            results.append(result)
-            recursive_get_files(result["contents"].get("files", []))
-
-    result = get_file_from_list(repo, file_paths)
-    already_fetched.append(result["path"])
-    results.append(result)
-    recursive_get_files(result["contents"].get("files", []))
+            visited.add(path)
+            results.append(fetched[path])
+            add_files(fetched[path]["contents"].get("files", []))
+
+    add_files(first["contents"].get("files", []))
     return results
 
 
@@ -129,54 +262,135 @@ def get_deployments(source):
 
 
 def get_repo_installation(org_name, repo_name):
+    """
+    Get the repository, logged in as the installation of the app that has access to it.
+
+    Which installation that is and the details of the repository are cached for a few
+    minutes, so this normally doesn't need any requests to GitHub.
+    """
     gh = login_as_app()
+    key = repo_cache_key(org_name, repo_name)
+    cached = cache.get(key)
+    if cached:
+        gh_installation = login_as_installation_id(gh, cached["installation"])
+        return gh_installation.create_from_raw_data(Repository, cached["raw_data"])
+
     try:
         installation = gh.get_repo_installation(org_name, repo_name)
         gh_installation = login_as_installation(gh, installation)
-        return gh_installation.get_repo(f"{org_name}/{repo_name}")
+        repo = gh_installation.get_repo(f"{org_name}/{repo_name}")
     except UnknownObjectException:
         raise NoRepository(
             f"GitHub app is unable to access the repository: `{org_name}/{repo_name}`."
         )
 
+    if isinstance(installation.id, int):
+        cached = {"installation": installation.id, "raw_data": repo.raw_data}
+        cache.set(key, cached, repo_timeout)
+    return repo
+
+
+def repo_cache_key(org_name, repo_name):
+    return f"gh:repo:{org_name}/{repo_name}".lower()
+
+
+def forget_repo_installation(org_name, repo_name):
+    """Stop using the cached installation for the repository, and its token."""
+    key = repo_cache_key(org_name, repo_name)
+    cached = cache.get(key)
+    if cached:
+        forget_installation_token(cached["installation"])
+    cache.delete(key)
+
+
+@contextmanager
+def forget_on_error(org_name, repo_name):
+    """
+    If GitHub says the app can't access the repository anymore, forget the installation
+    so the next attempt looks it up again.
+    """
+    try:
+        yield
+    except NoRepository:
+        forget_repo_installation(org_name, repo_name)
+        raise
+    except GithubException as error:
+        if error.status == 401:
+            forget_repo_installation(org_name, repo_name)
+        raise
+
+
+def get_installations(gh):
+    """
+    The installations of the app on organizations, keyed by the login of the organization
+    in lower case. The installations are only listed once.
+    """
+    return {
+        installation.raw_data["account"]["login"].lower(): installation
+        for installation in gh.get_installations()
+        if installation.target_type == "Organization"
+    }
+
+
+def scan_installations(gh, installations, fetch):
+    """
+    Call fetch for each of the installations at once, on a bounded pool, yielding each
+    result as soon as it is ready. The order of the results is not kept.
+
+    Fetch is passed the installation and a client logged in as it. The clients are logged
+    in here, one at a time, because getting a token uses the app's client, and a client's
+    connection can't be shared between threads.
+    """
+    clients = [
+        (installation, login_as_installation(gh, installation)) for installation in installations
+    ]
+    with ThreadPoolExecutor(max_workers=settings.GITHUB_FETCH_WORKERS) as pool:
+        futures = [pool.submit(metrics.bind(fetch), *args) for args in clients]
+        for future in as_completed(futures):
+            yield future.result()
+
 
 def get_repositories(org_name):
+    """
+    Yield the repositories in the organization, a page at a time as they come back from
+    GitHub, rather than waiting for all of them.
+
+    Raises NoRepository if the app isn't installed on the organization, rather than
+    yielding nothing, which would look like an organization with no repositories.
+    """
     gh = login_as_app()
-    repos = []
-    for installation in gh.get_installations():
-        if installation.target_type == "Organization":
-            if installation.raw_data["account"]["login"] != org_name:
-                break
+    installation = get_installations(gh).get(org_name.lower())
+    if installation is None:
+        raise NoRepository(f"GitHub app is not installed on the organization: `{org_name}`.")
 
-            gh_installation = login_as_installation(gh, installation)
-            try:
-                org = gh_installation.get_organization(org_name)
-            except UnknownObjectException:
-                raise NoRepository(f"Unable to access the organization: `{org_name}`.")
+    gh_installation = login_as_installation(gh, installation)
+    try:
+        org = gh_installation.get_organization(org_name)
+    except UnknownObjectException:
+        raise NoRepository(f"Unable to access the organization: `{org_name}`.")
 
-            installations = org.get_installations()
-            for org_install in installations:
-                for repo in org_install.get_repos():
-                    repos.append(repo)
+    for org_install in org.get_installations():
+        # This lists the repositories the installation token can access, which are the
+        # same for every installation in the org, so only one is needed.
+        yield from org_install.get_repos()
+        return
 
-    return repos
+    raise NoRepository(f"GitHub app is not installed on the organization: `{org_name}`.")
 
 
 def get_orgs():
+    """Yield the organizations the app is installed on, as each one is fetched."""
     gh = login_as_app()
-    orgs = []
-    for installation in gh.get_installations():
-        if installation.target_type == "Organization":
-            account = installation.raw_data["account"]
-            gh_installation = login_as_installation(gh, installation)
-            org = gh_installation.get_organization(account["login"])
-            orgs.append(
-                {
-                    "login": account["login"],
-                    "html_url": account["html_url"],
-                    "account": account,
-                    "installation": installation,
-                    "raw_data": org.raw_data,
-                }
-            )
-    return orgs
+
+    def get_org(installation, gh_installation):
+        account = installation.raw_data["account"]
+        org = gh_installation.get_organization(account["login"])
+        return {
+            "login": account["login"],
+            "html_url": account["html_url"],
+            "account": account,
+            "installation": installation,
+            "raw_data": org.raw_data,
+        }
+
+    yield from scan_installations(gh, get_installations(gh).values(), get_org)
@@ -0,0 +1,70 @@
+import time
+
+from django.core.cache import cache
+
+# What to assume for an org that hasn't been seen yet, this is the limit for an app
+# installation. See: https://docs.github.com/en/rest/overview/resources-in-the-rest-api#rate-limiting
+default_limit = 5000
+# How long the rate limit window is.
+window = 60 * 60
+
+
+def budget_key(org_name):
+    return f"gh:budget:{org_name.lower()}"
+
+
+def record(org_name, requester):
+    """
+    Record how much of the rate limit is left for the installation on the org, from the
+    headers of the last response the requester got.
+    """
+    rate_limiting = requester.rate_limiting
+    reset = requester.rate_limiting_resettime
+    if not isinstance(rate_limiting, tuple) or not isinstance(reset, int):
+        return
+
+    remaining, limit = rate_limiting
+    # Nothing has been requested yet, so there's nothing to record.
+    if remaining < 0:
+        return
+
+    budget = {"remaining": remaining, "limit": limit, "reset": reset}
+    cache.set(budget_key(org_name), budget, max(reset - int(time.time()), 1))
+
+
+def get_budget(org_name):
+    """
+    Returns how much of the rate limit is left for the org and when it resets, as a
+    timestamp. If nothing has been recorded, or the last window has reset, the whole limit
+    is assumed to be available.
+    """
+    budget = cache.get(budget_key(org_name))
+    if budget is None or budget["reset"] <= time.time():
+        return {
+            "remaining": default_limit,
+            "limit": default_limit,
+            "reset": int(time.time()) + window,
+        }
+    return budget
+
+
+def reserve(org_name, reset, count, available):
+    """
+    Reserve room for up to `count` sources out of the `available` for the org in the window
+    that resets at `reset`, and return how many were reserved. This is an atomic increment,
+    so schedulers running at the same time don't plan to use the same part of the limit.
+    """
+    # A window that hasn't been recorded resets an hour from whenever it's looked up, so
+    # the window is keyed by the hour rather than the exact reset time.
+    key = f"gh:reserved:{org_name.lower()}:{reset // window}"
+    cache.add(key, 0, max(reset - int(time.time()), 1))
+    try:
+        reserved = cache.incr(key, count)
+    except ValueError:
+        # The window reset in between.
+        return count
+
+    over = min(max(reserved - available, 0), count)
+    if over:
+        cache.decr(key, over)
+    return count - over
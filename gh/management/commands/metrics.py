@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from gh import metrics
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="Print out the metrics as JSON.",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Clear all the metrics, after printing them out.",
+        )
+
+    def handle(self, *args, **options):
+        report = metrics.report()
+        if options.get("json"):
+            print(json.dumps(report, indent=2))
+        else:
+            print(f"{'Calls':>8} {'Avg ms':>8} {'Errors':>8}  Task / Endpoint")
+            for entry in report["endpoints"]:
+                errors = sum(entry["errors"].values())
+                print(
+                    f"{entry['calls']:>8} {entry['average_ms']:>8} {errors:>8}  "
+                    f"{entry['task']} {entry['verb']} {entry['endpoint']}"
+                )
+            for installation, budget in report["installations"].items():
+                print(
+                    f"Installation {installation}: {budget['remaining']} of {budget['limit']} left."
+                )
+
+        if options.get("reset"):
+            metrics.reset()
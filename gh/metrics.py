@@ -0,0 +1,229 @@
+import logging
+import re
+import time
+from contextvars import ContextVar
+from urllib.parse import urlparse
+
+from celery import current_task
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# The requester methods that all the requests to GitHub go through.
+methods = ["requestJson", "requestMultipart", "requestBlob"]
+
+# The upper bounds of the latency histogram, in milliseconds.
+buckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+prefix = "gh:metrics"
+# The keys that have been recorded are kept in numbered slots, with a counter of how many
+# slots there are. Both are only ever added to, so no key is lost to a concurrent update.
+count_key = f"{prefix}:count"
+
+# The task that work running in another thread was handed off from, see `bind`.
+bound_task = ContextVar("bound_task", default=None)
+
+# Endpoints that take a path or a SHA after them, which are collapsed so that each file
+# or commit doesn't get its own endpoint.
+collapse = {"contents": ":path", "trees": ":sha", "blobs": ":sha", "commits": ":sha"}
+
+
+def instrument(client, installation="user"):
+    """
+    Wrap the requester of a PyGithub client, so that every request made through it, or
+    through any object it returns, is recorded. Works for both `Github` and
+    `GithubIntegration`.
+    """
+    requester = getattr(client, "_Github__requester", None) or getattr(
+        client, "_GithubIntegration__requester", None
+    )
+    if requester is None or getattr(requester, "_instrumented", False):
+        return client
+
+    for name in methods:
+        setattr(requester, name, wrap(requester, getattr(requester, name), installation))
+    requester._instrumented = True
+    return client
+
+
+def wrap(requester, method, installation):
+    def wrapped(verb, url, *args, **kwargs):
+        start = time.monotonic()
+        error = None
+        status = None
+        try:
+            status, headers, output = method(verb, url, *args, **kwargs)
+            return status, headers, output
+        except Exception as exc:
+            error = exc.__class__.__name__
+            raise
+        finally:
+            try:
+                duration = (time.monotonic() - start) * 1000
+                if error is None and status >= 400:
+                    error = f"HTTP-{status}"
+                record(verb, url, duration, error)
+                record_remaining(installation, requester)
+            except Exception:
+                # Recording metrics must never break the request.
+                logger.exception("Unable to record GitHub metrics.")
+
+    return wrapped
+
+
+def endpoint(url):
+    """Turn the url into an endpoint, without the ids and names in it."""
+    parts = [part for part in urlparse(url).path.split("/") if part]
+    if parts and parts[0] == "api":
+        # GitHub Enterprise has the API under /api/v3.
+        parts = parts[2:]
+    if len(parts) >= 3 and parts[0] == "repos":
+        parts[1:3] = [":owner", ":repo"]
+    if len(parts) >= 2 and parts[0] in ("orgs", "users"):
+        parts[1] = ":name"
+
+    result = []
+    for part in parts:
+        if result and result[-1] in collapse:
+            result.append(collapse[result[-1]])
+            break
+        result.append(":id" if re.fullmatch(r"\d+", part) else part)
+    return "/" + "/".join(result)
+
+
+def task_name():
+    if bound_task.get():
+        return bound_task.get()
+    if current_task and current_task.request.id:
+        return current_task.name
+    return "web"
+
+
+def bind(func):
+    """
+    Wrap a function that is run in another thread, such as on a pool, so that requests
+    it makes are recorded against the task that wrapped it. The current task is only
+    known in the thread it's running in.
+    """
+    name = task_name()
+
+    def bound(*args, **kwargs):
+        token = bound_task.set(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bound_task.reset(token)
+
+    return bound
+
+
+def series(verb, url):
+    return f"{task_name()}|{verb}|{endpoint(url)}"
+
+
+def incr(key, amount=1):
+    """Increment a counter, adding it to the index the first time it's seen."""
+    key = f"{prefix}:{key}"
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if cache.add(key, 0, None):
+            add_to_index(key)
+        cache.incr(key, amount)
+
+
+def add_to_index(key):
+    cache.add(count_key, 0, None)
+    cache.set(slot_key(cache.incr(count_key)), key, None)
+
+
+def slot_key(slot):
+    return f"{prefix}:index:{slot}"
+
+
+def index():
+    """The keys that have been recorded, as the slots in the index."""
+    slots = [slot_key(slot) for slot in range(1, cache.get(count_key, 0) + 1)]
+    return slots, set(cache.get_many(slots).values())
+
+
+def record(verb, url, duration, error):
+    name = series(verb, url)
+    incr(f"calls:{name}")
+    incr(f"ms:{name}", int(duration))
+    bucket = next((bound for bound in buckets if duration <= bound), "inf")
+    incr(f"bucket:{bucket}:{name}")
+    if error:
+        incr(f"error:{error}:{name}")
+
+
+def record_remaining(installation, requester):
+    remaining, limit = requester.rate_limiting
+    if remaining < 0:
+        return
+
+    key = f"{prefix}:remaining:{installation}"
+    value = {
+        "remaining": remaining,
+        "limit": limit,
+        "reset": requester.rate_limiting_resettime,
+        "recorded": int(time.time()),
+    }
+    if cache.add(key, value, None):
+        add_to_index(key)
+    else:
+        cache.set(key, value, None)
+
+
+def report():
+    """
+    Everything that has been recorded, as:
+    {
+        "endpoints": [{"task", "verb", "endpoint", "calls", "average_ms", "latency", "errors"}],
+        "installations": {installation: {"remaining", "limit", "reset", "recorded"}},
+    }
+    """
+    _, keys = index()
+    values = cache.get_many(keys)
+    endpoints, installations = {}, {}
+    for key, value in values.items():
+        kind, rest = key[len(prefix) + 1 :].split(":", 1)
+        if kind == "remaining":
+            installations[rest] = value
+            continue
+
+        label = None
+        if kind in ("bucket", "error"):
+            label, rest = rest.split(":", 1)
+        task, verb, name = rest.split("|", 2)
+        entry = endpoints.setdefault(
+            rest,
+            {
+                "task": task,
+                "verb": verb,
+                "endpoint": name,
+                "calls": 0,
+                "ms": 0,
+                "latency": {},
+                "errors": {},
+            },
+        )
+        if kind == "bucket":
+            entry["latency"][label] = value
+        elif kind == "error":
+            entry["errors"][label] = value
+        else:
+            entry[kind] = value
+
+    for entry in endpoints.values():
+        entry["average_ms"] = round(entry.pop("ms") / entry["calls"]) if entry["calls"] else 0
+
+    return {
+        "endpoints": sorted(endpoints.values(), key=lambda entry: -entry["calls"]),
+        "installations": installations,
+    }
+
+
+def reset():
+    slots, keys = index()
+    cache.delete_many([*slots, *keys, count_key])
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+
+def dedupe(apps, schema_editor):
+    WebhookDelivery = apps.get_model("gh", "WebhookDelivery")
+    WebhookDelivery.objects.filter(guid="").update(guid=None)
+
+    # Keep the first delivery for each guid.
+    first = (
+        WebhookDelivery.objects.exclude(guid=None)
+        .order_by("guid", "pk")
+        .distinct("guid")
+        .values_list("pk", flat=True)
+    )
+    WebhookDelivery.objects.exclude(guid=None).exclude(pk__in=list(first)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gh", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="webhookdelivery",
+            name="guid",
+            field=models.CharField(blank=True, max_length=36, null=True),
+        ),
+        migrations.RunPython(dedupe, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="webhookdelivery",
+            name="guid",
+            field=models.CharField(blank=True, max_length=36, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gh", "0002_alter_webhookdelivery_guid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="claimed",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
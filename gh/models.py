@@ -0,0 +1,39 @@
+from django.db import models
+
+# Where a webhook delivery is in being processed.
+DELIVERY_STATUS_CHOICES = (
+    ("pending", "Pending"),  # Received, but not processed yet.
+    ("processed", "Processed"),  # The handler for the event ran.
+    ("failed", "Failed"),  # The handler for the event raised an error, it may be retried.
+)
+
+
+class WebhookDelivery(models.Model):
+    """
+    A webhook received from GitHub. These are stored as they arrive and processed later
+    in batches, so that GitHub gets a response straight away.
+    """
+
+    # The X-GitHub-Delivery header, GitHub sends the same one when it retries a delivery.
+    guid = models.CharField(max_length=36, blank=True, null=True, unique=True)
+    # The X-GitHub-Event header.
+    event = models.CharField(max_length=100)
+    payload = models.JSONField()
+
+    status = models.CharField(
+        max_length=10, default="pending", choices=DELIVERY_STATUS_CHOICES, db_index=True
+    )
+    # Any error from processing the delivery.
+    error = models.TextField(blank=True)
+    # How many times processing the delivery has been started, and when it last was.
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed = models.DateTimeField(blank=True, null=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = "webhook deliveries"
+
+    def __str__(self):
+        return f"{self.event} - {self.guid} - {self.status}"
@@ -1,5 +1,6 @@
 import base64
 import json
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.urls import reverse
@@ -8,27 +9,56 @@ from catalog.errors import SendError
 from health.serializers import CheckResultSerializer, CheckSerializer
 from services.serializers import ServiceSerializer, SourceSerializer
 
-from .fetch import get_repo_installation, url_to_nwo
+from . import limits
+from .fetch import forget_on_error, get_repo_installation, url_to_nwo
 
 
-def dispatch(result):
+@contextmanager
+def check_repository():
+    """The repository that checks are sent to, recording the rate limit after using it."""
+    nwo = url_to_nwo(settings.GITHUB_CHECK_REPOSITORY)
+    with forget_on_error(*nwo):
+        repo = get_repo_installation(*nwo)
+        try:
+            yield repo
+        finally:
+            limits.record(nwo[0], repo._requester)
+
+
+def dispatch(result, serialized=None):
     """Send checks to GitHub as repository dispatch"""
-    repo = get_repo_installation(*url_to_nwo(settings.GITHUB_CHECK_REPOSITORY))
+    with check_repository() as repo:
+        dispatch_to_repo(repo, result, serialized)
+
+
+def dispatch_batch(check, results, serialized=None):
+    """
+    Send the results for many services for one check to GitHub as one repository dispatch,
+    with a manifest of the results for the Action to work through and send back together.
+    """
+    with check_repository() as repo:
+        dispatch_batch_to_repo(repo, check, results, serialized)
 
+
+def dispatch_to_repo(repo, result, serialized=None):
     # The general principle here is to send as much data as possible so that the API
     # has to do as little as possible work to call back to the service catalog to decide
     # what to do.
-    data = json.dumps(
+    service = result.service
+    source = serialize(SourceSerializer, service.source, serialized) if service else "null"
+    data = join_json(
         {
-            "server": {
-                "url": settings.SERVER_URL,
-                "endpoint": reverse("health:api-result-detail", args=[result.id]),
-            },
-            "check": CheckSerializer(result.health_check).data,
-            "result": CheckResultSerializer(result).data,
-            "service": ServiceSerializer(result.service).data if result.service else None,
-            "source": SourceSerializer(result.service.source).data if result.service else None,
-            "catalog.json": result.service.raw_data if result.service else None,
+            "server": json.dumps(
+                {
+                    "url": settings.SERVER_URL,
+                    "endpoint": reverse("health:api-result-detail", args=[result.id]),
+                }
+            ),
+            "check": serialize(CheckSerializer, result.health_check, serialized),
+            "result": json.dumps(CheckResultSerializer(result).data),
+            "service": json.dumps(ServiceSerializer(service).data if service else None),
+            "source": source,
+            "catalog.json": json.dumps(service.raw_data if service else None),
         }
     )
     # GitHub is assuming that the data is a string when you access the payload
@@ -40,9 +70,8 @@ def dispatch(result):
     # just encode the data.
     #
     # Perhaps there's a better way to do this, but this works for now.
-    data = base64.b64encode(data.encode("utf-8")).decode("utf-8")
     payload = {
-        "data": data,
+        "data": encode(data),
         # Things that are really useful to have and can be accessed directly.
         "check": result.health_check.slug,
         "service": result.service.slug if result.service else None,
@@ -50,8 +79,87 @@ def dispatch(result):
         "server": settings.SERVER_URL,
     }
 
-    res = repo.create_repository_dispatch(
-        event_type=result.health_check.slug, client_payload=payload
+    send_to_repo(repo, result.health_check.slug, payload)
+
+
+def dispatch_batch_to_repo(repo, check, results, serialized=None):
+    # Only what's needed to identify each service is sent, so that the payload stays small
+    # however many services there are. The Action can get the rest from the API.
+    manifest = []
+    for result in results:
+        manifest.append(
+            {
+                "id": result.id,
+                "endpoint": reverse("health:api-result-detail", args=[result.id]),
+                "service": result.service.slug,
+                "repository": "/".join(url_to_nwo(result.service.source.url)),
+            }
+        )
+    data = join_json(
+        {
+            "server": json.dumps(
+                {"url": settings.SERVER_URL, "endpoint": reverse("health:api-result-batch")}
+            ),
+            "check": serialize(CheckSerializer, check, serialized),
+            "results": json.dumps(manifest),
+        }
     )
+    payload = {
+        "data": encode(data),
+        "check": check.slug,
+        "services": len(manifest),
+        "batch": True,
+        "server": settings.SERVER_URL,
+    }
+    send_to_repo(repo, check.slug, payload)
+
+
+def serialize(serializer_class, instance, serialized=None):
+    """
+    The instance as JSON. `serialized` is the JSON of the instances that have already been
+    serialized in a sweep, keyed by `serialized_key`, so that each one is only serialized
+    once however many services it's sent for.
+    """
+    if serialized is None:
+        return json.dumps(serializer_class(instance).data)
+
+    key = serialized_key(instance)
+    if key not in serialized:
+        serialized[key] = json.dumps(serializer_class(instance).data)
+    return serialized[key]
+
+
+def serialized_key(instance):
+    return f"{instance._meta.label_lower}:{instance.pk}"
+
+
+def serialize_for(check, services, serialized):
+    """
+    Serialize the check and the sources of the services into `serialized`, if they haven't
+    been already in the sweep. Returns just the JSON for them, to pass to a task that sends
+    the check to the services.
+    """
+    instances = [(CheckSerializer, check)]
+    instances.extend((SourceSerializer, service.source) for service in services)
+    return {
+        serialized_key(instance): serialize(serializer_class, instance, serialized)
+        for serializer_class, instance in instances
+    }
+
+
+def join_json(parts):
+    """
+    Join values that are already JSON into a JSON object, the same as `json.dumps` would
+    produce for the values before they were encoded.
+    """
+    return "{" + ", ".join(f"{json.dumps(key)}: {value}" for key, value in parts.items()) + "}"
+
+
+def encode(data):
+    return base64.b64encode(data.encode("utf-8")).decode("utf-8")
+
+
+def send_to_repo(repo, event_type, payload):
+    res = repo.create_repository_dispatch(event_type=event_type, client_payload=payload)
     if not res:
         raise SendError("Unable to dispatch repository event.")
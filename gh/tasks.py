@@ -0,0 +1,77 @@
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from catalog.celery import app
+from gh.models import WebhookDelivery
+from gh.webhooks import events
+
+logger = logging.getLogger(__name__)
+
+# How many deliveries to process in each batch.
+batch_size = 50
+# How many times to try processing a delivery before giving up on it.
+max_attempts = 5
+# How long to wait before trying a delivery again. This is also how long a delivery that
+# was claimed by a task that never finished it waits before it's tried again.
+retry_after = timedelta(minutes=30)
+
+
+@app.task
+def process_webhooks():
+    """
+    Process all the pending webhook deliveries and retry the failed ones, oldest first, in
+    batches. Each batch is claimed first, so that tasks running at the same time don't
+    process the same delivery twice, and then processed once that has been committed, so
+    that no rows are locked while the handlers wait on GitHub.
+    """
+    processed = 0
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            batch = list(
+                WebhookDelivery.objects.filter(
+                    Q(claimed__isnull=True) | Q(claimed__lt=now - retry_after),
+                    status__in=["pending", "failed"],
+                    attempts__lt=max_attempts,
+                )
+                .order_by("created")
+                .select_for_update(skip_locked=True)[:batch_size]
+            )
+            for delivery in batch:
+                delivery.attempts += 1
+                delivery.claimed = now
+            WebhookDelivery.objects.bulk_update(batch, ["attempts", "claimed"])
+
+        for delivery in batch:
+            process_delivery(delivery)
+        WebhookDelivery.objects.bulk_update(batch, ["status", "error", "processed"])
+
+        processed += len(batch)
+        if len(batch) < batch_size:
+            return processed
+
+
+def process_delivery(delivery):
+    logger.info(f"Task: processing {delivery.event} webhook: {delivery.guid}")
+    try:
+        # Not in a transaction, so that one isn't held open while the handler waits on
+        # GitHub. The handlers use their own around what they change.
+        events[delivery.event](delivery.payload)
+    except Exception as error:
+        logger.exception(f"Unable to process {delivery.event} webhook: {delivery.guid}")
+        delivery.status = "failed"
+        delivery.error = str(error)
+    else:
+        delivery.status = "processed"
+        delivery.error = ""
+    delivery.processed = timezone.now()
+
+
+@app.task
+def truncate_webhooks(ago):
+    queryset = WebhookDelivery.objects.filter(created__lt=timezone.now() - timedelta(days=ago))
+    queryset.delete()
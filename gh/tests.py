@@ -1,32 +1,61 @@
 import base64
+import hashlib
+import hmac
 import json
+import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from unittest.mock import ANY, Mock, patch
 
+from auditlog.models import LogEntry
+from django.core.cache import cache
+from django.db import connection
 from django.shortcuts import reverse
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from faker import Faker
-from github import GithubException, UnknownObjectException
+from github import Github, GithubException, UnknownObjectException
 
 from catalog import errors
+from catalog.tests import BaseTestCase
 from events.models import Event
+from health.serializers import CheckSerializer
 from health.tests import create_health_check, create_health_check_result
 from services.models import Source
+from services.tasks import refresh_source_from_github
 from services.tests import create_service, create_source
 from user_profile.models import Profile
 
+from . import limits, metrics
 from .create import create_action_file, create_json_file
 from .fetch import (
     file_paths,
+    forget_on_error,
     get,
     get_contents,
     get_file,
     get_file_from_list,
+    get_files,
+    get_orgs,
+    get_repo_installation,
+    get_repositories,
+    get_tree,
     url_to_nwo,
 )
-from .send import dispatch
-from .user import login_as_user
-from .webhooks import find_service, handle_deployment, handle_release
+from .models import WebhookDelivery
+from .send import dispatch, dispatch_batch, join_json
+from .tasks import process_webhooks, truncate_webhooks
+from .user import (
+    forget_installation_token,
+    get_installation_token,
+    login_as_app,
+    login_as_user,
+)
+from .webhooks import find_service, handle_deployment, handle_push, handle_release
 
 fake = Faker("en_US")
 
@@ -57,6 +86,34 @@ class TestUser(WithGitHubUser):
         self.assertTrue(gh)
         assert gh_mock.called
 
+    @patch.dict("os.environ", {"GITHUB_APP_ID": "1", "GITHUB_PEM": "pem"})
+    @patch.dict("gh.user._app")
+    @patch("gh.user.CachedIntegration")
+    def test_login_as_app_cached(self, integration_mock):
+        """The app is only created again when its JWT is about to expire."""
+        integration_mock.return_value.jwt_expiry = 600
+        self.assertIs(login_as_app(), login_as_app())
+        self.assertEquals(integration_mock.call_count, 1)
+        with patch("gh.user.time.time", return_value=time.time() + 600):
+            login_as_app()
+        self.assertEquals(integration_mock.call_count, 2)
+
+    def test_installation_token_cached(self):
+        """The installation token is reused until it's about to expire."""
+        cache.clear()
+        integration = Mock()
+        integration.get_access_token.return_value = Mock(
+            token="first", expires_at=datetime.utcnow() + timedelta(hours=1)
+        )
+        self.assertEquals(get_installation_token(integration, 1), "first")
+        self.assertEquals(get_installation_token(integration, 1), "first")
+        self.assertEquals(integration.get_access_token.call_count, 1)
+
+        with patch("gh.user.time.time", return_value=time.time() + 60 * 60):
+            integration.get_access_token.return_value.token = "second"
+            self.assertEquals(get_installation_token(integration, 1), "second")
+        forget_installation_token(1)
+
 
 class TestFetch(WithGitHubUser):
     def setUp(self):
@@ -79,6 +136,76 @@ class TestFetch(WithGitHubUser):
         repo.get_contents.return_value = contents
         self.assertEquals(get_contents(repo, "test.json5"), {"key": "value"})
 
+    def get_cached_repo(self):
+        cache.clear()
+        repo = Mock(full_name="andy/gh", url="https://api.github.com/repos/andy/gh")
+        repo.get_contents.return_value = Mock(
+            decoded_content=b'{"key": "value"}', etag='"first"', sha="first"
+        )
+        get_contents(repo, "catalog.json")
+        return repo
+
+    def test_get_contents_not_modified(self):
+        """If the file has not changed, the cached contents are used."""
+        repo = self.get_cached_repo()
+        repo._requester.requestJson.return_value = (304, {}, "")
+        self.assertEquals(get_contents(repo, "catalog.json"), {"key": "value"})
+        self.assertEquals(repo.get_contents.call_count, 1)
+        repo._requester.requestJson.assert_called_with(
+            "GET",
+            "https://api.github.com/repos/andy/gh/contents/catalog.json",
+            headers={"If-None-Match": '"first"'},
+        )
+
+    def test_get_contents_modified(self):
+        """If the file has changed, the new contents are used and cached."""
+        repo = self.get_cached_repo()
+        body = {"sha": "second", "content": base64.b64encode(b'{"key": "new"}').decode()}
+        repo._requester.requestJson.return_value = (200, {"etag": '"second"'}, json.dumps(body))
+        self.assertEquals(get_contents(repo, "catalog.json"), {"key": "new"})
+        repo._requester.requestJson.return_value = (304, {}, "")
+        self.assertEquals(get_contents(repo, "catalog.json"), {"key": "new"})
+        self.assertEquals(repo.get_contents.call_count, 1)
+
+    def test_get_contents_known_sha(self):
+        """If the SHA from the tree matches the cache, no request is made."""
+        repo = self.get_cached_repo()
+        self.assertEquals(get_contents(repo, "catalog.json", sha="first"), {"key": "value"})
+        repo._requester.requestJson.assert_not_called()
+
+    def test_get_file_from_tree(self):
+        """The file is picked from the tree, without trying the other paths."""
+        repo = Mock(default_branch="main")
+        repo.get_git_tree.return_value = Mock(
+            truncated=False,
+            tree=[
+                Mock(path=".github", type="tree", sha="1"),
+                Mock(path=".github/catalog.json", type="blob", sha="2"),
+                Mock(path="README.md", type="blob", sha="3"),
+            ],
+        )
+        self.assertEquals(get_tree(repo), {".github/catalog.json": "2", "README.md": "3"})
+        with patch("gh.fetch.get_contents", return_value=self.simple_data) as get_contents_mock:
+            result = get_file_from_list(repo, file_paths)
+        self.assertEquals(result["path"], ".github/catalog.json")
+        get_contents_mock.assert_called_once_with(repo, ".github/catalog.json", sha="2")
+        repo.get_git_tree.assert_called_with("main", recursive=True)
+
+    def test_get_file_from_tree_missing(self):
+        """If the tree has none of the paths, nothing else is fetched."""
+        repo = Mock(default_branch="main")
+        repo.get_git_tree.return_value = Mock(truncated=False, tree=[])
+        with patch("gh.fetch.get_contents") as get_contents_mock:
+            self.assertRaises(errors.NoEntryFound, get_file_from_list, repo, file_paths)
+        get_contents_mock.assert_not_called()
+
+    def test_get_contents_error(self):
+        """If the conditional request fails, the file is fetched the normal way."""
+        repo = self.get_cached_repo()
+        repo._requester.requestJson.return_value = (404, {}, "")
+        repo.get_contents.side_effect = UnknownObjectException(404, "Not Found", {})
+        self.assertRaises(UnknownObjectException, get_contents, repo, "catalog.json")
+
     @patch("gh.user.Github")
     @patch("gh.fetch.get_contents")
     def test_get_file_errors(self, get_contents_mock, gh_mock):
@@ -148,6 +275,223 @@ class TestFetch(WithGitHubUser):
         self.assertEquals(len(result), 2)
         self.assertEquals(result[1], {"contents": data, "path": "catalog2.json"})
 
+    @patch("gh.fetch.login_as_app")
+    @patch("gh.fetch.login_as_installation")
+    @patch("gh.fetch.get_contents")
+    def test_get_data_nested_files(self, get_contents_mock, as_installation_mock, as_app_mock):
+        """
+        Test that nested files are returned depth first, and each file only once.
+        """
+        files = {
+            "catalog.json": ["a.json", "b.json"],
+            "a.json": ["c.json", "b.json"],
+            "b.json": ["catalog.json"],
+            "c.json": [],
+        }
+        get_contents_mock.side_effect = lambda repo, path, sha=None: {
+            **self.simple_data,
+            "files": files[path],
+        }
+        result = get(self.source)
+        self.assertEquals(
+            [r["path"] for r in result], ["catalog.json", "a.json", "c.json", "b.json"]
+        )
+        self.assertEquals(get_contents_mock.call_count, 4)
+
+    @patch("services.tasks.ingest")
+    @patch("gh.fetch.login_as_app")
+    @patch("gh.fetch.login_as_installation")
+    @patch("gh.fetch.get_contents")
+    def test_get_data_nested_files_metrics(
+        self, get_contents_mock, as_installation_mock, as_app_mock, ingest_mock
+    ):
+        """Files fetched on other threads are recorded against the task fetching them."""
+        files = {"catalog.json": ["a.json", "b.json", "c.json"], "a.json": [], "b.json": []}
+
+        def get_contents(repo, path, sha=None):
+            metrics.record("GET", f"/repos/andy/gh/contents/{path}", 10, None)
+            return {**self.simple_data, "files": files.get(path, [])}
+
+        get_contents_mock.side_effect = get_contents
+        ingest_mock.return_value = {"errors": []}
+        metrics.reset()
+        with self.settings(GITHUB_FETCH_WORKERS=2):
+            refresh_source_from_github.apply(args=[self.source.slug])
+        [entry] = metrics.report()["endpoints"]
+        self.assertEquals(entry["task"], "services.tasks.refresh_source_from_github")
+        self.assertEquals(entry["calls"], 4)
+
+    @patch("gh.fetch.get_contents")
+    def test_get_files_client_per_thread(self, get_contents_mock):
+        """Each thread fetches files with its own client."""
+        files = {
+            "catalog.json": ["a.json", "b.json", "c.json"],
+            "a.json": [],
+            "b.json": [],
+            "c.json": [],
+        }
+        used = {}
+
+        def get_contents(repo, path, sha=None):
+            if path != "catalog.json":
+                used.setdefault(id(repo), set()).add(threading.get_ident())
+            return {**self.simple_data, "files": files[path]}
+
+        get_contents_mock.side_effect = get_contents
+        repo = Mock(get_git_tree=Mock(side_effect=GithubException(500, "", {})))
+        open_repo = Mock(side_effect=lambda: Mock())
+        with self.settings(GITHUB_FETCH_WORKERS=2):
+            result = get_files(repo, open_repo)
+        self.assertEquals(len(result), 4)
+        self.assertEquals(open_repo.call_count, 1)
+        self.assertEquals(len(used), 2)
+        self.assertTrue(all(len(threads) == 1 for threads in used.values()))
+
+    @patch("gh.fetch.login_as_installation_id")
+    @patch("gh.fetch.login_as_installation")
+    @patch("gh.fetch.login_as_app")
+    def test_get_repo_installation_cached(self, as_app_mock, as_installation_mock, as_id_mock):
+        """The installation and repository are only looked up once."""
+        cache.clear()
+        as_app_mock.return_value.get_repo_installation.return_value = Mock(id=1)
+        as_installation_mock.return_value.get_repo.return_value = Mock(raw_data={"id": 2})
+        get_repo_installation("andy", "gh")
+        repo = get_repo_installation("andy", "gh")
+        self.assertEquals(as_app_mock.return_value.get_repo_installation.call_count, 1)
+        as_id_mock.assert_called_once_with(as_app_mock.return_value, 1)
+        self.assertEquals(repo, as_id_mock.return_value.create_from_raw_data.return_value)
+
+        # If GitHub says the app can no longer access it, it's looked up again.
+        with self.assertRaises(GithubException):
+            with forget_on_error("andy", "gh"):
+                raise GithubException(401, "Bad credentials", {})
+        get_repo_installation("andy", "gh")
+        self.assertEquals(as_app_mock.return_value.get_repo_installation.call_count, 2)
+
+    def installation(self, login):
+        return Mock(
+            target_type="Organization",
+            raw_data={"account": {"login": login, "html_url": f"https://github.com/{login}"}},
+        )
+
+    @patch("gh.fetch.login_as_installation")
+    @patch("gh.fetch.login_as_app")
+    def test_get_repositories_other_org_first(self, as_app_mock, as_installation_mock):
+        """Repositories are found even if another org's installation is listed first."""
+        as_app_mock.return_value.get_installations.return_value = [
+            self.installation("other"),
+            self.installation("Andy"),
+        ]
+        org = as_installation_mock.return_value.get_organization.return_value
+        org.get_installations.return_value = [Mock(), Mock()]
+        org.get_installations.return_value[0].get_repos.return_value = ["a", "b"]
+        self.assertEquals(list(get_repositories("andy")), ["a", "b"])
+        as_installation_mock.assert_called_once_with(
+            as_app_mock.return_value, as_app_mock.return_value.get_installations.return_value[1]
+        )
+
+    @patch("gh.fetch.login_as_app")
+    def test_get_repositories_not_installed(self, as_app_mock):
+        """An org the app isn't installed on is an error, not an empty org."""
+        as_app_mock.return_value.get_installations.return_value = [self.installation("other")]
+        with self.assertRaises(errors.NoRepository):
+            list(get_repositories("andy"))
+
+    @patch("gh.fetch.login_as_installation")
+    @patch("gh.fetch.login_as_app")
+    def test_get_orgs(self, as_app_mock, as_installation_mock):
+        """Every org the app is installed on is returned."""
+        as_app_mock.return_value.get_installations.return_value = [
+            self.installation("andy"),
+            self.installation("other"),
+            Mock(target_type="User"),
+        ]
+        threads = []
+
+        def login(gh, installation):
+            threads.append(threading.get_ident())
+            return Mock()
+
+        as_installation_mock.side_effect = login
+        orgs = get_orgs()
+        self.assertEquals(sorted(org["login"] for org in orgs), ["andy", "other"])
+        # The tokens are only got in this thread, not in the threads fetching the orgs.
+        self.assertEquals(threads, [threading.get_ident()] * 2)
+
+    def test_record_rate_limit(self):
+        """The rate limit left is recorded from the requester, until it resets."""
+        cache.clear()
+        self.assertEquals(limits.get_budget("andy")["remaining"], limits.default_limit)
+        reset = int(time.time()) + 60
+        limits.record("Andy", Mock(rate_limiting=(10, 5000), rate_limiting_resettime=reset))
+        self.assertEquals(
+            limits.get_budget("andy"), {"remaining": 10, "limit": 5000, "reset": reset}
+        )
+        # Nothing has been requested, so nothing is changed.
+        limits.record("andy", Mock(rate_limiting=(-1, -1), rate_limiting_resettime=0))
+        self.assertEquals(limits.get_budget("andy")["remaining"], 10)
+
+
+class TestMetrics(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_endpoint(self):
+        """Ids, names and paths are taken out of the endpoint."""
+        for url, expected in [
+            ("/repos/andy/gh/contents/a/b.json", "/repos/:owner/:repo/contents/:path"),
+            (
+                "https://api.github.com/repos/andy/gh/git/trees/main",
+                "/repos/:owner/:repo/git/trees/:sha",
+            ),
+            ("/app/installations/123/access_tokens", "/app/installations/:id/access_tokens"),
+            ("/orgs/andy", "/orgs/:name"),
+            ("https://ghe.example.com/api/v3/orgs/andy/installations", "/orgs/:name/installations"),
+        ]:
+            self.assertEquals(metrics.endpoint(url), expected)
+
+    def test_instrument(self):
+        """Requests through the client are counted, with their errors and the rate limit."""
+        gh = metrics.instrument(Github("token"), installation=1)
+        requester = gh._Github__requester
+        with patch.object(requester, "_Requester__requestRaw") as raw:
+            raw.return_value = (
+                200,
+                {"x-ratelimit-remaining": "10", "x-ratelimit-limit": "5000"},
+                "{}",
+            )
+            gh.get_repo("andy/gh")
+            raw.return_value = (404, {}, '{"message": "Not Found"}')
+            self.assertRaises(UnknownObjectException, gh.get_repo, "andy/gh")
+
+        report = metrics.report()
+        [entry] = report["endpoints"]
+        self.assertEquals(
+            (entry["task"], entry["verb"], entry["endpoint"], entry["calls"]),
+            ("web", "GET", "/repos/:owner/:repo", 2),
+        )
+        self.assertEquals(entry["errors"], {"HTTP-404": 1})
+        self.assertEquals(sum(entry["latency"].values()), 2)
+        self.assertEquals(report["installations"]["1"]["remaining"], 10)
+
+    def test_record_concurrently(self):
+        """Metrics recorded from many threads at once are all reported."""
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda i: metrics.record("GET", f"/thing{i}", 10, None), range(30)))
+        self.assertEquals(len(metrics.report()["endpoints"]), 30)
+        metrics.reset()
+        self.assertEquals(metrics.report()["endpoints"], [])
+
+    def test_api(self):
+        self.api_login()
+        response = self.api_client.get(reverse("github:api-metrics"))
+        self.assertEquals(response.json(), {"endpoints": [], "installations": {}})
+
+    def test_api_unauth(self):
+        response = self.api_client.get(reverse("github:api-metrics"))
+        self.assertEquals(response.status_code, 401)
+
 
 def unpack_data(data):
     return json.loads(base64.b64decode(data).decode("utf-8"))
@@ -176,6 +520,62 @@ class TestSend(WithGitHubUser):
         self.assertEqual(data["service"]["slug"], objects["service"].slug)
         self.assertEqual(data["source"]["slug"], objects["source"].slug)
 
+    @patch("gh.send.get_repo_installation")
+    def test_dispatch_batch(self, login_mock):
+        """
+        Sends one dispatch event for many results, with a manifest of the results.
+        """
+        objects = create_health_check()
+        other = create_service(objects["source"])
+        results = [
+            create_health_check_result(objects["health_check"], service)
+            for service in [objects["service"], other]
+        ]
+        with self.settings(GITHUB_CHECK_REPOSITORY="https://github.com/foo/bar"):
+            dispatch_batch(objects["health_check"], results)
+        login_mock.return_value.create_repository_dispatch.assert_called_once()
+        args = login_mock.return_value.create_repository_dispatch.call_args
+        self.assertEqual(args[1]["event_type"], objects["health_check"].slug)
+
+        payload = args[1]["client_payload"]
+        data = unpack_data(payload["data"])
+        self.assertEqual((payload["batch"], payload["services"]), (True, 2))
+        self.assertEqual(data["server"]["endpoint"], reverse("health:api-result-batch"))
+        self.assertEqual([entry["id"] for entry in data["results"]], [r.pk for r in results])
+        self.assertEqual(data["results"][1]["service"], other.slug)
+
+    @patch("gh.send.get_repo_installation")
+    def test_dispatch_serializes_check_once(self, login_mock):
+        """
+        The check and source are serialized once for many results sent in the same sweep.
+        """
+        objects = create_health_check()
+        other = create_service(objects["source"])
+        results = [
+            create_health_check_result(objects["health_check"], service)
+            for service in [objects["service"], other]
+        ]
+        serialized = {}
+        with self.settings(GITHUB_CHECK_REPOSITORY="https://github.com/foo/bar"):
+            with patch("gh.send.CheckSerializer", wraps=CheckSerializer) as serializer:
+                for result in results:
+                    dispatch(result, serialized)
+                self.assertEqual(serializer.call_count, 1)
+
+                # Without a sweep, it's serialized every time.
+                dispatch(results[0])
+                self.assertEqual(serializer.call_count, 2)
+
+        self.assertEqual(len(serialized), 2)
+        args = login_mock.return_value.create_repository_dispatch.call_args
+        data = unpack_data(args[1]["client_payload"]["data"])
+        self.assertEqual(data["check"]["slug"], objects["health_check"].slug)
+        self.assertEqual(data["source"]["slug"], objects["source"].slug)
+
+    def test_join_json(self):
+        parts = {"a": json.dumps([1, "two"]), "b": json.dumps(None), "c": json.dumps({"d": 1})}
+        self.assertEqual(join_json(parts), json.dumps({"a": [1, "two"], "b": None, "c": {"d": 1}}))
+
     @patch("gh.fetch.login_as_app")
     def test_dispatch_failed(self, gh_mock):
         """
@@ -242,6 +642,96 @@ class TestWebhooks(WithGitHubUser):
     def test_webhook_no_mocks(self):
         self.assertEqual(self.client.post(self.url).status_code, 400)
 
+    @patch("gh.tasks.process_webhooks.delay")
+    def test_webhook_stored(self, mock_delay):
+        """The delivery is stored and processing is queued, without running the handler."""
+        body = json.dumps(self.get_release_payload()).encode("utf-8")
+        secret = os.environ["GITHUB_WEBHOOK_SECRET"].encode("utf-8")
+        signature = hmac.new(secret, msg=body, digestmod=hashlib.sha1).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(
+                self.url,
+                body,
+                content_type="application/json",
+                HTTP_X_GITHUB_EVENT="release",
+                HTTP_X_GITHUB_DELIVERY="abc",
+                HTTP_X_HUB_SIGNATURE=f"sha1={signature}",
+            )
+        self.assertEqual(res.status_code, 202)
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(
+            (delivery.guid, delivery.event, delivery.status), ("abc", "release", "pending")
+        )
+        self.assertEqual(res.json()["id"], delivery.pk)
+        self.assertEqual(Event.objects.count(), 0)
+        mock_delay.assert_called_once()
+
+        # GitHub sending the delivery again doesn't store it again.
+        mock_delay.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(
+                self.url,
+                body,
+                content_type="application/json",
+                HTTP_X_GITHUB_EVENT="release",
+                HTTP_X_GITHUB_DELIVERY="abc",
+                HTTP_X_HUB_SIGNATURE=f"sha1={signature}",
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {"status": "duplicate", "id": delivery.pk})
+        self.assertEqual(WebhookDelivery.objects.count(), 1)
+        mock_delay.assert_not_called()
+
+    @patch("gh.webhooks.requests.get")
+    def test_process_webhooks(self, mock_get):
+        """Pending deliveries are processed, and a failure doesn't stop the others."""
+        mock_get.side_effect = ValueError("Oops")
+        failed = WebhookDelivery.objects.create(
+            event="deployment", payload=self.get_deployment_payload()
+        )
+        processed = WebhookDelivery.objects.create(
+            event="release", payload=self.get_release_payload()
+        )
+        with patch("gh.tasks.batch_size", 1):
+            self.assertEqual(process_webhooks(), 2)
+
+        failed.refresh_from_db()
+        processed.refresh_from_db()
+        self.assertEqual((failed.status, failed.error), ("failed", "Oops"))
+        self.assertEqual(processed.status, "processed")
+        self.assertIsNotNone(processed.processed)
+        self.assertEqual(Event.objects.get().type, "release")
+        # Already processed deliveries are left alone, failed ones are retried later.
+        self.assertEqual(process_webhooks(), 0)
+
+        mock_get.side_effect = None
+        mock_get.return_value.json.return_value = [{"state": "success"}]
+        WebhookDelivery.objects.update(claimed=timezone.now() - timedelta(hours=1))
+        self.assertEqual(process_webhooks(), 1)
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.error, failed.attempts), ("processed", "", 2))
+
+    @patch("gh.webhooks.requests.get")
+    def test_process_webhooks_attempts(self, mock_get):
+        """A delivery that keeps failing is only tried so many times."""
+        mock_get.side_effect = ValueError("Oops")
+        delivery = WebhookDelivery.objects.create(
+            event="deployment", payload=self.get_deployment_payload(), attempts=4
+        )
+        self.assertEqual(process_webhooks(), 1)
+        WebhookDelivery.objects.update(claimed=timezone.now() - timedelta(hours=1))
+        self.assertEqual(process_webhooks(), 0)
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.status, delivery.attempts), ("failed", 5))
+
+    def test_truncate_webhooks(self):
+        """Old deliveries are removed."""
+        old = WebhookDelivery.objects.create(event="release", payload={}, status="processed")
+        WebhookDelivery.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(31))
+        recent = WebhookDelivery.objects.create(event="release", payload={})
+        truncate_webhooks(30)
+        self.assertEqual(list(WebhookDelivery.objects.all()), [recent])
+
     def get_deployment_payload(self):
         return {
             "deployment": {
@@ -273,6 +763,18 @@ class TestWebhooks(WithGitHubUser):
             list(find_service(self.get_deployment_payload(), "deployment", "deployments"))
         )
 
+    def test_find_service_url(self):
+        """Services are found in one query, whatever the case of the url or a trailing slash."""
+        other = create_service(self.source)
+        other.events = ["releases"]
+        other.save()
+
+        payload = self.get_deployment_payload()
+        payload["repository"]["html_url"] = self.source.url.upper() + "/"
+        with self.assertNumQueries(1):
+            services = find_service(payload, "deployment", "deployments")
+        self.assertEqual(services, [self.service])
+
     def test_no_events(self):
         self.service.events = []
         self.service.save()
@@ -314,6 +816,65 @@ class TestWebhooks(WithGitHubUser):
         self.assertEqual(event.customers, True)
         self.assertEqual(event.active, True)
 
+    def test_handle_release_queries(self):
+        """The events for all the services are added in the same number of queries."""
+        with CaptureQueriesContext(connection) as one:
+            handle_release(self.get_release_payload())
+        for _ in range(10):
+            create_service(self.source)
+        with CaptureQueriesContext(connection) as many:
+            handle_release(self.get_release_payload())
+
+        self.assertEqual(len(one), len(many))
+        self.assertEqual(Event.objects.count(), 12)
+        self.assertEqual(LogEntry.objects.get_for_model(Event).count(), 12)
+
+    def test_handle_release_again(self):
+        """The same release updates the event, rather than adding another one."""
+        payload = self.get_release_payload()
+        handle_release(payload)
+        payload["release"]["body"] = "Changed"
+        handle_release(payload)
+        handle_release(payload)
+
+        event = Event.objects.get()
+        self.assertEqual(event.description, "Changed")
+        self.assertEqual(list(event.services.all()), [self.service])
+        self.assertEqual(LogEntry.objects.get_for_object(event).count(), 2)
+
+    def get_push_payload(self, *paths, ref="refs/heads/main"):
+        return {
+            "ref": ref,
+            "commits": [{"added": [], "modified": list(paths), "removed": []}],
+            "repository": {"html_url": self.source.url, "default_branch": "main"},
+        }
+
+    @patch("gh.webhooks.refresh_source_from_github")
+    def test_handle_push(self, mock_refresh):
+        """A push that changes a catalog file refreshes the source."""
+        self.service.path = "services/api.json"
+        self.service.raw_data = {"files": ["services/web.json"]}
+        self.service.save()
+        for path in ["catalog.json", "services/api.json", "services/web.json"]:
+            mock_refresh.reset_mock()
+            handle_push(self.get_push_payload("README.md", path))
+            mock_refresh.delay.assert_called_once_with(self.source.slug)
+
+    @patch("gh.webhooks.refresh_source_from_github")
+    def test_handle_push_skipped(self, mock_refresh):
+        """Pushes to other branches, or that don't change a catalog file, are skipped."""
+        handle_push(self.get_push_payload("README.md"))
+        handle_push(self.get_push_payload("catalog.json", ref="refs/heads/other"))
+        mock_refresh.delay.assert_not_called()
+
+    @patch("gh.webhooks.refresh_source_from_github")
+    def test_handle_push_too_many_commits(self, mock_refresh):
+        """If GitHub didn't send all the commits, the source is refreshed to be safe."""
+        payload = self.get_push_payload("README.md")
+        payload["commits"] = payload["commits"] * 20
+        handle_push(payload)
+        mock_refresh.delay.assert_called_once_with(self.source.slug)
+
 
 class TestCreateJSON(WithGitHubUser):
     def setUp(self):
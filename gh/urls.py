@@ -1,10 +1,11 @@
 from django.urls import path
 
-from . import webhooks
+from . import views, webhooks
 
 app_name = "github"  # pylint: disable=invalid-name
 
 
 urlpatterns = [
     path("webhooks/", webhooks.webhooks, name="webhooks"),
+    path("api/metrics/", views.api_metrics, name="api-metrics"),
 ]
@@ -1,23 +1,63 @@
+import calendar
 import logging
 import os
+import time
+from datetime import datetime
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from github import Github, GithubIntegration, enable_console_debug_logging
+from github import Consts, Github, GithubIntegration, enable_console_debug_logging
 from oauthlogin.models import OAuthConnection
 
+from .metrics import instrument
+
 logger = logging.getLogger(__name__)
 
 if settings.GITHUB_DEBUG:
     enable_console_debug_logging()
 
 
+# Refresh JWTs and tokens this many seconds before they expire, so that one doesn't expire
+# part way through a task.
+expiry_margin = 60
+
+# The app and the installation tokens are kept for this process, installation tokens are
+# also kept in the cache so other processes can use them.
+_app = {"key": None, "integration": None, "expires": 0}
+_tokens = {}
+
+
+class CachedIntegration(GithubIntegration):
+    """A GithubIntegration that reuses the JWT it signed until shortly before it expires."""
+
+    def create_jwt(self):
+        now = time.time()
+        cached = getattr(self, "_jwt", None)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        token = super().create_jwt()
+        self._jwt = (token, now + self.jwt_expiry - expiry_margin)
+        return token
+
+
 def login_as_app():
     """Login as the app."""
     if not os.environ.get("GITHUB_APP_ID") or not os.environ.get("GITHUB_PEM"):
         raise ImproperlyConfigured("GITHUB_APP_ID and GITHUB_PEM must be set.")
-    return GithubIntegration(os.environ.get("GITHUB_APP_ID"), os.environ.get("GITHUB_PEM"))
+
+    key = (os.environ.get("GITHUB_APP_ID"), os.environ.get("GITHUB_PEM"))
+    # The integration signs a JWT when it is created and uses it for some requests, so
+    # a new one is needed before that JWT expires.
+    if _app["key"] != key or _app["expires"] <= time.time():
+        integration = instrument(
+            CachedIntegration(*key, jwt_expiry=Consts.MAX_JWT_EXPIRY), installation="app"
+        )
+        expires = time.time() + integration.jwt_expiry - expiry_margin
+        _app.update({"key": key, "integration": integration, "expires": expires})
+    return _app["integration"]
 
 
 def login_as_user(user):
@@ -29,13 +69,49 @@ def login_as_user(user):
     if connection.access_token_expired():
         connection.refresh_access_token()
 
-    return Github(connection.access_token)
+    return instrument(Github(connection.access_token))
 
 
 def login_as_installation(github_integration, installation):
     """Login as installation"""
-    access_token = github_integration.get_access_token(installation.id)
-    return Github(access_token.token)
+    return login_as_installation_id(github_integration, installation.id)
+
+
+def login_as_installation_id(github_integration, installation_id):
+    """Login as installation, when only the id of the installation is known."""
+    token = get_installation_token(github_integration, installation_id)
+    return instrument(Github(token), installation=installation_id)
+
+
+def get_installation_token(github_integration, installation_id):
+    """
+    Get an access token for the installation, creating a new one only when there isn't
+    one for the installation that is valid for a while longer.
+    """
+    now = time.time()
+    cached = _tokens.get(installation_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    key = f"gh:installation-token:{installation_id}"
+    cached = cache.get(key)
+    if not cached or cached[1] <= now:
+        access_token = github_integration.get_access_token(installation_id)
+        if not isinstance(access_token.expires_at, datetime):
+            return access_token.token
+
+        expires = calendar.timegm(access_token.expires_at.utctimetuple()) - expiry_margin
+        cached = (access_token.token, expires)
+        cache.set(key, cached, max(int(expires - now), 1))
+
+    _tokens[installation_id] = cached
+    return cached[0]
+
+
+def forget_installation_token(installation_id):
+    """Stop using the token for the installation, for example if it has been revoked."""
+    _tokens.pop(installation_id, None)
+    cache.delete(f"gh:installation-token:{installation_id}")
 
 
 def check_org_membership(username, org):
@@ -0,0 +1,13 @@
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from . import metrics
+
+
+@api_view(["GET"])
+def api_metrics(request):
+    """
+    The requests made to GitHub, by the task that made them and the endpoint, with how long
+    they took and what errors came back. Also the rate limit left for each installation.
+    """
+    return Response(metrics.report())
@@ -1,3 +1,4 @@
+import copy
 import hashlib
 import hmac
 import json
@@ -5,16 +6,29 @@ import logging
 import os
 
 import requests
+from auditlog.models import LogEntry
+from django.db import transaction
 from django.http import HttpResponseBadRequest, JsonResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 from events.models import Event
-from services.models import Source
-from web.shortcuts import get_object_or_None
+from gh import fetch
+from gh.models import WebhookDelivery
+from services.models import Service, Source, repository_key
+from services.tasks import refresh_source_from_github
+from systemlogs.bulk import bulk_log
 
 logger = logging.getLogger(__name__)
 
+# The most commits GitHub includes in a push webhook.
+max_push_commits = 20
+# How long to wait for GitHub when getting the status of a deployment.
+request_timeout = 10
+# The fields that an event from a webhook is looked up by, see `Event.Meta.constraints`.
+event_fields = ["source", "external_id", "name"]
+
 
 @csrf_exempt
 @require_POST
@@ -47,49 +61,149 @@ def webhooks(request):
         return HttpResponseBadRequest("Unsupported X-GITHUB-EVENT header found: {}".format(event))
 
     payload = json.loads(request.body.decode("utf-8"))
-    response = events[event](payload) or {"status": "ok"}
-    return JsonResponse(response)
+    guid = request.META.get("HTTP_X_GITHUB_DELIVERY") or None
+    if guid is None:
+        delivery = WebhookDelivery.objects.create(event=event, payload=payload)
+    else:
+        delivery, created = WebhookDelivery.objects.get_or_create(
+            guid=guid, defaults={"event": event, "payload": payload}
+        )
+        if not created:
+            logger.info(f"Skipping webhook, delivery {guid} has already been received.")
+            return JsonResponse({"status": "duplicate", "id": delivery.pk})
+
+    transaction.on_commit(queue_processing)
+    return JsonResponse({"status": "queued", "id": delivery.pk}, status=202)
+
+
+def queue_processing():
+    from gh.tasks import process_webhooks
+
+    try:
+        process_webhooks.delay()
+    except Exception:
+        # The delivery is stored, so the periodic task will get to it.
+        logger.exception("Unable to queue processing of webhooks.")
 
 
 def handle_deployment(payload):
-    for service in find_service(payload, "deployment", "deployments"):
-        status = requests.get(payload["deployment"]["statuses_url"]).json()[0]["state"]
+    services = find_service(payload, "deployment", "deployments")
+    if not services:
+        return
+
+    # The status is the same for all the services, so only get it once.
+    response = requests.get(payload["deployment"]["statuses_url"], timeout=request_timeout)
+    status = response.json()[0]["state"]
+    entries = []
+    for service in services:
         description = payload["deployment"]["description"]
         if not description:
             description = f'Deployment of {service.name} to {payload["deployment"]["environment"]}'
-        event = Event.objects.create(
-            name=f'Deployment of {service.name} to {payload["deployment"]["environment"]}',
-            type="deployment",
-            customers=payload["deployment"]["environment"] == "production",
-            active=True,
-            description=description,
-            status=status,
-            source="GitHub",
-            url=payload["deployment"]["url"],
-            external_id=payload["deployment"]["id"],
-        )
-        event.services.add(service)
+        fields = {
+            "name": f'Deployment of {service.name} to {payload["deployment"]["environment"]}',
+            "type": "deployment",
+            "customers": payload["deployment"]["environment"] == "production",
+            "active": True,
+            "description": description,
+            "status": status,
+            "source": "GitHub",
+            "url": payload["deployment"]["url"],
+            "external_id": str(payload["deployment"]["id"]),
+        }
+        entries.append((service, fields))
+    upsert_events(entries)
 
 
-def find_service(payload, webhook_type, event_type):
-    repository = payload["repository"]["html_url"]
-    source = get_object_or_None(Source, url=repository)
-    if not source:
-        logger.info(f"Skipping {webhook_type} webhook, no source found for {repository}")
-        return
+def event_key(fields):
+    return tuple(fields[name] for name in event_fields)
 
-    for service in source.services.all():
-        if not service.active:
-            logger.info(f"Skipping {webhook_type} webhook inactive service {service}")
-            continue
 
-        if not service.events or event_type not in service.events:
-            logger.info(
-                f"Skipping release {webhook_type} service, {service} does not have `{event_type}` in events."
-            )
+def get_events(keys):
+    """The events for the (source, external_id, name) keys, keyed by them."""
+    if not keys:
+        return {}
+    sources, external_ids, names = (set(values) for values in zip(*keys))
+    events = Event.objects.filter(source__in=sources, external_id__in=external_ids, name__in=names)
+    return {
+        key: event
+        for event in events
+        if (key := (event.source, event.external_id, event.name)) in keys
+    }
+
+
+def upsert_events(entries):
+    """
+    Add the events for the services, or update them if they are already there, so that
+    getting the same webhook again doesn't add more events. Entries are a list of
+    (service, fields). This is a fixed number of queries no matter how many services there
+    are, and events that haven't changed are not saved.
+    """
+    fields_by_key = {event_key(fields): fields for _, fields in entries}
+    existing = get_events(fields_by_key.keys())
+
+    now = timezone.now()
+    new, updated, changed_fields = [], [], set()
+    for key, fields in fields_by_key.items():
+        event = existing.get(key)
+        if event is None:
+            new.append(Event(**fields))
             continue
 
-        yield service
+        changed = [name for name, value in fields.items() if getattr(event, name) != value]
+        if changed:
+            old = copy.copy(event)
+            for name in changed:
+                setattr(event, name, fields[name])
+            event.updated = now
+            updated.append((old, event))
+            changed_fields.update(changed)
+
+    Through = Event.services.through
+    with transaction.atomic():
+        # An event could have been added since they were looked up, so skip any conflicts
+        # and then look up the ones that were actually created.
+        Event.objects.bulk_create(new, ignore_conflicts=True)
+        created = get_events(fields_by_key.keys() - existing.keys())
+        existing.update(created)
+
+        Event.objects.bulk_update(
+            [event for _, event in updated], sorted(changed_fields) + ["updated"]
+        )
+        Through.objects.bulk_create(
+            [
+                Through(event_id=existing[event_key(fields)].pk, service_id=service.pk)
+                for service, fields in entries
+            ],
+            ignore_conflicts=True,
+        )
+        bulk_log(LogEntry.Action.CREATE, [(None, event) for event in created.values()])
+        bulk_log(LogEntry.Action.UPDATE, updated)
+
+
+def find_source(url, **filters):
+    """The source for the repository url, no matter the case or a trailing slash."""
+    return Source.objects.filter(repository=repository_key(url), **filters).first()
+
+
+def find_service(payload, webhook_type, event_type):
+    """
+    The active services in the source for the repository, that have `event_type` in
+    their events.
+    """
+    repository = payload["repository"]["html_url"]
+    services = list(
+        Service.objects.filter(
+            source__repository=repository_key(repository),
+            active=True,
+            events__contains=[event_type],
+        ).only("name", "slug")
+    )
+    if not services:
+        logger.info(
+            f"Skipping {webhook_type} webhook, no active services in {repository} "
+            f"have `{event_type}` in events."
+        )
+    return services
 
 
 def handle_release(payload):
@@ -97,26 +211,69 @@ def handle_release(payload):
         logger.info(f"Skipping release webhook, action {payload['action']} not supported")
         return
 
+    entries = []
     for service in find_service(payload, "release", "releases"):
         default_msg = f'{service.name}: {payload["release"]["name"]} {payload["action"]}'
         description = payload["release"]["body"]
         if not description:
             description = default_msg
-        event = Event.objects.create(
-            name=default_msg,
-            type="release",
-            customers=not payload["release"]["prerelease"],
-            active=not payload["release"]["draft"],
-            description=description,
-            status=payload["action"],
-            source="GitHub",
-            url=payload["release"]["html_url"],
-            external_id=payload["release"]["id"],
-        )
-        event.services.add(service)
+        fields = {
+            "name": default_msg,
+            "type": "release",
+            "customers": not payload["release"]["prerelease"],
+            "active": not payload["release"]["draft"],
+            "description": description,
+            "status": payload["action"],
+            "source": "GitHub",
+            "url": payload["release"]["html_url"],
+            "external_id": str(payload["release"]["id"]),
+        }
+        entries.append((service, fields))
+    upsert_events(entries)
+
+
+def handle_push(payload):
+    """
+    Refresh the source if a push to the default branch changes any of its catalog files.
+    """
+    repository = payload["repository"]
+    if payload.get("ref") != f'refs/heads/{repository.get("default_branch")}':
+        logger.info(f"Skipping push webhook, not to the default branch of {repository['html_url']}")
+        return
+
+    source = find_source(repository["html_url"], active=True)
+    if not source:
+        logger.info(f"Skipping push webhook, no active source found for {repository['html_url']}")
+        return
+
+    commits = payload.get("commits", [])
+    changed = set()
+    for commit in commits:
+        for key in ["added", "modified", "removed"]:
+            changed.update(commit.get(key, []))
+
+    # GitHub only sends up to 20 commits in the webhook, so if there are that many it
+    # can't tell what else changed.
+    if len(commits) < max_push_commits and not changed & catalog_paths(source):
+        logger.info(f"Skipping push webhook, no catalog files changed in {source.slug}")
+        return
+
+    refresh_source_from_github.delay(source.slug)
+
+
+def catalog_paths(source):
+    """All the paths in the source that catalog files were, or could be, fetched from."""
+    paths = set(fetch.file_paths)
+    for path, raw_data in source.services.values_list("path", "raw_data"):
+        if path:
+            paths.add(path)
+        if raw_data:
+            paths.update(raw_data.get("files", []))
+    return paths
 
 
 events = {
     "deployment": handle_deployment,
+    "push": handle_push,
     "release": handle_release,
 }
@@ -7,7 +7,24 @@ from .models import Check
 class CheckForm(forms.ModelForm):
     class Meta:
         model = Check
-        fields = ["name", "description", "frequency", "active", "limit", "services"]
+        fields = [
+            "name",
+            "description",
+            "frequency",
+            "cron",
+            "active",
+            "limit",
+            "services",
+            "batch_size",
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["batch_size"].required = False
+
+    def clean_batch_size(self):
+        # Leaving it out sends each service on its own, as it did before batches.
+        return self.cleaned_data.get("batch_size") or 1
 
     def is_valid(self):
         slug = slugify(self.data.get("name"))
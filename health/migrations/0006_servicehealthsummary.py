@@ -0,0 +1,78 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    Check = apps.get_model("health", "Check")
+    CheckResult = apps.get_model("health", "CheckResult")
+    Service = apps.get_model("services", "Service")
+    ServiceHealthSummary = apps.get_model("health", "ServiceHealthSummary")
+
+    checks = list(Check.objects.filter(active=True).values_list("pk", flat=True))
+    latest = {}
+    for result in (
+        CheckResult.objects.filter(health_check__in=checks, service__isnull=False)
+        .order_by("service", "health_check", "-created")
+        .distinct("service", "health_check")
+    ):
+        latest.setdefault(result.service_id, {})[str(result.health_check_id)] = {
+            "id": result.pk,
+            "result": result.result,
+            "status": result.status,
+        }
+
+    summaries = []
+    for pk in Service.objects.values_list("pk", flat=True):
+        results = latest.get(pk, {})
+        state = "not-run"
+        if results:
+            state = "failing"
+            if len(results) == len(checks):
+                if all(result["result"] == "pass" for result in results.values()):
+                    state = "passing"
+        summaries.append(ServiceHealthSummary(service_id=pk, state=state, results=results))
+    ServiceHealthSummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("services", "0008_alter_service_type"),
+        ("health", "0005_alter_check_services_alter_checkresult_service"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ServiceHealthSummary",
+            fields=[
+                (
+                    "service",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="health",
+                        serialize=False,
+                        to="services.service",
+                    ),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[
+                            ("not-run", "Not run"),
+                            ("passing", "Passing"),
+                            ("failing", "Failing"),
+                        ],
+                        db_index=True,
+                        default="not-run",
+                        max_length=10,
+                    ),
+                ),
+                ("results", models.JSONField(default=dict)),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("health", "0006_servicehealthsummary"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="checkresult",
+            index=models.Index(
+                fields=["health_check", "service", "created"], name="health_chec_health__79617b_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,132 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:59
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+from django.utils import timezone
+
+intervals = {
+    "hourly": timedelta(hours=1),
+    "daily": timedelta(days=1),
+    "weekly": timedelta(days=7),
+}
+
+
+def backfill(apps, schema_editor):
+    Check = apps.get_model("health", "Check")
+    CheckResult = apps.get_model("health", "CheckResult")
+    CheckSchedule = apps.get_model("health", "CheckSchedule")
+    Service = apps.get_model("services", "Service")
+
+    checks = list(Check.objects.filter(active=True, frequency__in=intervals.keys()))
+    last_runs = {
+        (row["health_check"], row["service"]): row["last"]
+        for row in CheckResult.objects.filter(health_check__in=checks)
+        .values("health_check", "service")
+        .annotate(last=Max("created"))
+    }
+    active = list(Service.objects.filter(active=True).values_list("pk", flat=True))
+
+    now = timezone.now()
+    schedules = []
+    for check in checks:
+        if check.limit == "all":
+            services = active
+        elif check.limit == "some":
+            services = list(check.services.values_list("pk", flat=True))
+        else:
+            services = [None]
+
+        for service in services:
+            last = last_runs.get((check.pk, service))
+            schedules.append(
+                CheckSchedule(
+                    health_check=check,
+                    service_id=service,
+                    next_run_at=now if last is None else last + intervals[check.frequency],
+                )
+            )
+    CheckSchedule.objects.bulk_create(schedules, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("services", "0009_source_repository"),
+        ("health", "0007_checkresult_last_run_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="check",
+            name="cron",
+            field=models.CharField(
+                blank=True,
+                help_text="If the frequency is cron, when this check will be run as a cron expression, for example <code>0 9 * * 1-5</code>. Times are in UTC.",
+                max_length=100,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="check",
+            name="frequency",
+            field=models.CharField(
+                choices=[
+                    ("hourly", "Hourly"),
+                    ("daily", "Daily"),
+                    ("weekly", "Weekly"),
+                    ("cron", "Cron"),
+                    ("ad-hoc", "Ad hoc"),
+                ],
+                default="daily",
+                help_text="How often this check will be run.",
+                max_length=10,
+            ),
+        ),
+        migrations.CreateModel(
+            name="CheckSchedule",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("next_run_at", models.DateTimeField(db_index=True)),
+                (
+                    "health_check",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="schedules",
+                        to="health.check",
+                    ),
+                ),
+                (
+                    "service",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="check_schedules",
+                        to="services.service",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="checkschedule",
+            constraint=models.UniqueConstraint(
+                fields=("health_check", "service"), name="unique_check_schedule"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="checkschedule",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("service", None)),
+                fields=("health_check",),
+                name="unique_check_schedule_no_service",
+            ),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
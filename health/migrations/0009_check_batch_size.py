@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2026-10-18 20:03
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("health", "0008_checkschedule"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="check",
+            name="batch_size",
+            field=models.PositiveIntegerField(
+                default=1,
+                help_text="How many services to send to GitHub in each repository dispatch. Above 1, each Action run gets a list of the results to send back, rather than just one.",
+                validators=[
+                    django.core.validators.MinValueValidator(1),
+                    django.core.validators.MaxValueValidator(100),
+                ],
+            ),
+        ),
+    ]
@@ -1,15 +1,23 @@
 from auditlog.registry import auditlog
+from celery.schedules import crontab
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.template.defaultfilters import slugify
 from django.urls import reverse
+from django.utils import timezone
 
 FREQUENCY_CHOICES = (
     ("hourly", "Hourly"),
     ("daily", "Daily"),
     ("weekly", "Weekly"),
+    ("cron", "Cron"),
     ("ad-hoc", "Ad hoc"),
 )
 
+# The most services that can be sent in one repository dispatch.
+max_batch_size = 100
+
 LIMIT = (
     ("all", "All"),
     ("some", "Some"),
@@ -28,6 +36,11 @@ class Check(models.Model):
         choices=FREQUENCY_CHOICES,
         help_text="How often this check will be run.",
     )
+    cron = models.CharField(
+        max_length=100,
+        blank=True,
+        help_text="If the frequency is cron, when this check will be run as a cron expression, for example <code>0 9 * * 1-5</code>. Times are in UTC.",
+    )
 
     active = models.BooleanField(default=True)
 
@@ -48,6 +61,12 @@ class Check(models.Model):
         help_text="If this health check is limited to some services, select them here.",
     )
 
+    batch_size = models.PositiveIntegerField(
+        default=1,
+        validators=[MinValueValidator(1), MaxValueValidator(max_batch_size)],
+        help_text="How many services to send to GitHub in each repository dispatch. Above 1, each Action run gets a list of the results to send back, rather than just one.",
+    )
+
     def save(self, *args, **kwargs):
         # Ensure that changing the name does not change the slug.
         if not self.slug:
@@ -55,6 +74,13 @@ class Check(models.Model):
 
         super().save(*args, **kwargs)
 
+    def clean(self):
+        if self.frequency == "cron":
+            try:
+                validate_cron(self.cron)
+            except ValueError as error:
+                raise ValidationError({"cron": f"Not a valid cron expression: {error}"})
+
     def get_services(check):
         from services.models import Service
 
@@ -71,6 +97,36 @@ class Check(models.Model):
         return reverse("health:checks-detail", kwargs={"slug": self.slug})
 
 
+def get_crontab(expression):
+    """
+    Parse a cron expression, in the usual order of minute, hour, day of month, month and
+    day of week. Raises a ValueError if it is not valid.
+    """
+    parts = expression.split()
+    if len(parts) != 5:
+        raise ValueError("expected 5 fields")
+
+    minute, hour, day_of_month, month_of_year, day_of_week = parts
+    return crontab(
+        minute=minute,
+        hour=hour,
+        day_of_month=day_of_month,
+        month_of_year=month_of_year,
+        day_of_week=day_of_week,
+    )
+
+
+def validate_cron(expression):
+    """
+    Raises a ValueError if the cron expression is not valid, or if it is valid but never
+    runs, such as on the 31st of February.
+    """
+    try:
+        get_crontab(expression).remaining_delta(timezone.now())
+    except RuntimeError:
+        raise ValueError("it never runs")
+
+
 # The status of sending the check result to the service.
 STATUS_CHOICES = (
     ("sent", "Sent"),  # We sent the status to the service.
@@ -113,6 +169,12 @@ class CheckResult(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # For finding when each check was last run against each service.
+            models.Index(fields=["health_check", "service", "created"]),
+        ]
+
     def __str__(self):
         if self.service is None:
             return f"{self.health_check} - {self.result}"
@@ -133,5 +195,117 @@ class CheckResult(models.Model):
         return reverse("health:results-detail", kwargs={"slug": self.slug})
 
 
+# The overall health of a service, across all the active checks.
+HEALTH_CHOICES = (
+    ("not-run", "Not run"),  # None of the active checks have been run against the service.
+    ("passing", "Passing"),  # All the active checks have been run and passed.
+    ("failing", "Failing"),  # At least one check has not passed, or has not been run yet.
+)
+
+
+def health_state(checks):
+    """
+    Work out the overall health from a list of checks and their latest results,
+    as returned by `latest_results`.
+    """
+    run = [entry["last"] for entry in checks if entry["last"] is not None]
+    if not run:
+        return "not-run"
+    if len(run) == len(checks) and all(result.result == "pass" for result in run):
+        return "passing"
+    return "failing"
+
+
+class ServiceHealthSummary(models.Model):
+    """
+    The latest result of each active check for a service and the overall health of
+    the service. This is kept up to date as results are saved and checks change, so that
+    the health of a service can be read without going through all the results.
+    """
+
+    service = models.OneToOneField(
+        to="services.Service",
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="health",
+    )
+    state = models.CharField(
+        max_length=10, default="not-run", choices=HEALTH_CHOICES, db_index=True
+    )
+    # The latest result for each active check, keyed by the check pk.
+    results = models.JSONField(default=dict)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.service_id} - {self.state}"
+
+
+class CheckSchedule(models.Model):
+    """
+    When a check should next be run against a service, or against no service if the check
+    doesn't have any. There's one for each service the active checks run against, kept up
+    to date as results are created and checks change, so that the checks that are due can
+    be found without going through all the checks, services and results.
+    """
+
+    health_check = models.ForeignKey(Check, on_delete=models.CASCADE, related_name="schedules")
+    service = models.ForeignKey(
+        to="services.Service",
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name="check_schedules",
+    )
+    next_run_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["health_check", "service"], name="unique_check_schedule"
+            ),
+            models.UniqueConstraint(
+                fields=["health_check"],
+                condition=models.Q(service=None),
+                name="unique_check_schedule_no_service",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.health_check_id} - {self.service_id} - {self.next_run_at}"
+
+
+def summarise(services=None):
+    """
+    Recalculate the health summary for the services, or all the services if none are
+    passed through. This is a fixed number of queries, no matter how many services.
+    """
+    from services.models import Service, latest_results
+
+    if services is None:
+        services = Service.objects.all()
+
+    summaries = []
+    for pk, checks in latest_results(list(services)).items():
+        results = {}
+        for entry in checks:
+            if entry["last"] is not None:
+                results[str(entry["check"].pk)] = {
+                    "id": entry["last"].pk,
+                    "result": entry["last"].result,
+                    "status": entry["last"].status,
+                }
+        summaries.append(
+            ServiceHealthSummary(service_id=pk, state=health_state(checks), results=results)
+        )
+
+    ServiceHealthSummary.objects.bulk_create(
+        summaries,
+        update_conflicts=True,
+        unique_fields=["service"],
+        update_fields=["state", "results", "updated"],
+    )
+
+
 auditlog.register(Check)
 auditlog.register(CheckResult)
@@ -0,0 +1,124 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max, Prefetch
+from django.utils import timezone
+
+from services.models import Service
+
+from .models import Check, CheckResult, CheckSchedule, get_crontab
+
+# How long after a check was last run against a service before it should run again.
+intervals = {
+    "hourly": timedelta(hours=1),
+    "daily": timedelta(days=1),
+    "weekly": timedelta(days=7),
+}
+# The frequencies that are run on a schedule, rather than only when asked.
+scheduled = list(intervals.keys()) + ["cron"]
+
+
+def next_run(check, last_run, now=None):
+    """When the check should next run, if it last ran at `last_run`."""
+    now = now or timezone.now()
+    if last_run is None:
+        return now
+    if check.frequency == "cron":
+        start, delta, _ = get_crontab(check.cron).remaining_delta(last_run)
+        return start + delta
+    return last_run + intervals[check.frequency]
+
+
+def is_due(check, last_run, now):
+    return next_run(check, last_run, now) <= now
+
+
+def last_runs(checks, services=None):
+    """When each check was last run against each service, keyed by (check pk, service pk)."""
+    results = CheckResult.objects.filter(health_check__in=checks)
+    if services is not None:
+        results = results.filter(service__in=services)
+    return {
+        (row["health_check"], row["service"]): row["last"]
+        for row in results.values("health_check", "service").annotate(last=Max("created"))
+    }
+
+
+def reschedule(checks=None, services=None):
+    """
+    Make the schedules match the active checks and the services they run against. Pass
+    `checks` when checks have changed, their schedules are worked out again. Pass
+    `services` when services have been added or changed, only their schedules are added or
+    removed. This is a fixed number of queries, no matter how many checks or services.
+    """
+    queryset = Check.objects.all()
+    if checks is not None:
+        queryset = queryset.filter(pk__in=[check.pk for check in checks])
+    queryset = queryset.prefetch_related(Prefetch("services", queryset=Service.objects.only("pk")))
+    active = [check for check in queryset if check.active and check.frequency in scheduled]
+
+    service_pks = None if services is None else {service.pk for service in services}
+    all_services = []
+    if any(check.limit == "all" for check in active):
+        all_services = Service.objects.filter(active=True)
+        if service_pks is not None:
+            all_services = all_services.filter(pk__in=service_pks)
+        all_services = list(all_services.values_list("pk", flat=True))
+
+    wanted = set()
+    for check in active:
+        if check.limit == "all":
+            pks = all_services
+        elif check.limit == "some":
+            pks = [service.pk for service in check.services.all()]
+            if service_pks is not None:
+                pks = [pk for pk in pks if pk in service_pks]
+        else:
+            pks = [None] if service_pks is None else []
+        wanted.update((check.pk, pk) for pk in pks)
+
+    existing = CheckSchedule.objects.all()
+    if checks is not None:
+        existing = existing.filter(health_check__in=[check.pk for check in checks])
+    if service_pks is not None:
+        existing = existing.filter(service__in=service_pks)
+    existing = {(row.health_check_id, row.service_id): row for row in existing}
+
+    runs = last_runs(active, service_pks) if wanted else {}
+    checks_by_pk = {check.pk: check for check in active}
+    now = timezone.now()
+    new, updated = [], []
+    for check_pk, service_pk in wanted:
+        check = checks_by_pk[check_pk]
+        next_run_at = next_run(check, runs.get((check_pk, service_pk)), now)
+        row = existing.get((check_pk, service_pk))
+        if row is None:
+            new.append(
+                CheckSchedule(
+                    health_check_id=check_pk, service_id=service_pk, next_run_at=next_run_at
+                )
+            )
+        elif checks is not None and row.next_run_at != next_run_at:
+            row.next_run_at = next_run_at
+            updated.append(row)
+
+    with transaction.atomic():
+        CheckSchedule.objects.filter(
+            pk__in=[row.pk for key, row in existing.items() if key not in wanted]
+        ).delete()
+        CheckSchedule.objects.bulk_create(new, ignore_conflicts=True)
+        CheckSchedule.objects.bulk_update(updated, ["next_run_at"])
+
+
+def ran(check, service_pk, when):
+    """Move the schedule on, after the check has been run against the service."""
+    CheckSchedule.objects.filter(health_check=check, service=service_pk).update(
+        next_run_at=next_run(check, when)
+    )
+
+
+def ran_services(check, services, when):
+    """Move the schedules on, after the check has been run against all the services."""
+    CheckSchedule.objects.filter(health_check=check, service__in=services).update(
+        next_run_at=next_run(check, when)
+    )
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Check, CheckResult
+from .models import RESULT_CHOICES, Check, CheckResult, validate_cron
 
 
 class CheckSerializer(serializers.ModelSerializer):
@@ -9,9 +9,24 @@ class CheckSerializer(serializers.ModelSerializer):
         fields = "__all__"
         read_only_fields = ["slug", "created", "updated"]
 
+    def validate(self, data):
+        frequency = data.get("frequency", getattr(self.instance, "frequency", None))
+        if frequency == "cron":
+            try:
+                validate_cron(data.get("cron", getattr(self.instance, "cron", "")))
+            except ValueError as error:
+                raise serializers.ValidationError({"cron": f"Not a valid cron expression: {error}"})
+        return data
+
 
 class CheckResultSerializer(serializers.ModelSerializer):
     class Meta:
         model = CheckResult
         fields = "__all__"
         read_only_fields = ["status", "created", "updated"]
+
+
+class CheckResultBatchSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    result = serializers.ChoiceField(choices=RESULT_CHOICES)
+    message = serializers.CharField(required=False, allow_blank=True)
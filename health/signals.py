@@ -0,0 +1,78 @@
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+
+from services.models import Service
+
+from . import schedule
+from .models import Check, CheckResult, summarise
+
+
+def result_saved_handler(sender, instance, created, **kwargs):
+    if instance.service_id is not None:
+        summarise([instance.service])
+    if created:
+        schedule.ran(instance.health_check, instance.service_id, instance.created)
+
+
+def result_deleted_handler(sender, instance, origin=None, **kwargs):
+    # Deleting a check or service cascades to its results, those handlers cover the summary.
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin_model is CheckResult and instance.service_id is not None:
+        summarise([instance.service])
+
+
+def check_pre_save_handler(sender, instance, **kwargs):
+    # Keep track of the fields as they were, so we know if they changed.
+    instance._was = (
+        Check.objects.filter(pk=instance.pk).values("active", "frequency", "cron", "limit").first()
+    )
+    instance._was_active = instance._was["active"] if instance._was else None
+
+
+def check_saved_handler(sender, instance, created, **kwargs):
+    # Activating or deactivating a check changes the health of every service.
+    if created or instance._was_active != instance.active:
+        summarise()
+
+    fields = {
+        "active": instance.active,
+        "frequency": instance.frequency,
+        "cron": instance.cron,
+        "limit": instance.limit,
+    }
+    if created or instance._was != fields:
+        schedule.reschedule(checks=[instance])
+
+
+def check_deleted_handler(sender, instance, **kwargs):
+    summarise()
+
+
+def check_services_changed_handler(sender, instance, action, reverse, **kwargs):
+    if action in ["post_add", "post_remove", "post_clear"]:
+        if reverse:
+            schedule.reschedule(services=[instance])
+        else:
+            schedule.reschedule(checks=[instance])
+
+
+def service_pre_save_handler(sender, instance, **kwargs):
+    instance._was_active = (
+        Service.objects.filter(pk=instance.pk).values_list("active", flat=True).first()
+    )
+
+
+def service_saved_handler(sender, instance, created, **kwargs):
+    # Adding, activating or deactivating a service changes the checks that run against it.
+    if created or instance._was_active != instance.active:
+        schedule.reschedule(services=[instance])
+
+
+post_save.connect(result_saved_handler, sender=CheckResult)
+post_delete.connect(result_deleted_handler, sender=CheckResult)
+pre_save.connect(check_pre_save_handler, sender=Check)
+post_save.connect(check_saved_handler, sender=Check)
+post_delete.connect(check_deleted_handler, sender=Check)
+m2m_changed.connect(check_services_changed_handler, sender=Check.services.through)
+pre_save.connect(service_pre_save_handler, sender=Service)
+post_save.connect(service_saved_handler, sender=Service)
@@ -1,18 +1,37 @@
+import copy
+import logging
+from collections import defaultdict
 from datetime import timedelta
 
+from auditlog.models import LogEntry
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
 from catalog.celery import app
 from catalog.errors import NoRepository, SendError
 from gh import send
-from health.models import Check, CheckResult
+from gh.send import serialize_for
+from health import schedule
+from health.models import Check, CheckResult, CheckSchedule, summarise
 from services.models import Service
+from systemlogs.bulk import bulk_log
+
+logger = logging.getLogger(__name__)
+
+# How many schedules to send at once.
+batch_size = 500
+# How long to wait before trying to schedule a check again, if it couldn't be.
+retry_after = timedelta(hours=1)
+
+# How many results to time out at once.
+timeout_batch_size = 1000
 
 
 def should_run(check, service=None, quiet=False):
     now = timezone.now()
     frequency = check.frequency
-    if frequency not in ["hourly", "daily", "weekly"]:
+    if frequency not in schedule.scheduled:
         return False
 
     # If there's no services defined, but you've sent a service that's a failure.
@@ -22,26 +41,9 @@ def should_run(check, service=None, quiet=False):
     recent_result = (
         CheckResult.objects.filter(health_check=check, service=service).order_by("-created").first()
     )
-
-    # If this has never been run, then we should run it.
-    if recent_result is None:
+    if schedule.is_due(check, recent_result.created if recent_result else None, now):
         return True
 
-    most_recent = recent_result.created
-
-    # If this has been run more than an hour ago, then we should run it.
-    if frequency == "hourly":
-        if (now - most_recent).seconds > 3600:
-            return True
-
-    elif frequency == "daily":
-        if (now - most_recent).days > 0:
-            return True
-
-    elif frequency == "weekly":
-        if (now - most_recent).days >= 7:
-            return True
-
     if not quiet:
         print(f"Check {check.slug} at frequency {frequency} has been run recently, skipping.")
 
@@ -49,11 +51,11 @@ def should_run(check, service=None, quiet=False):
 
 
 @app.task
-def send_to_github(check_slug, service_slug=None):
+def send_to_github(check_slug, service_slug=None, serialized=None):
     check = Check.objects.get(slug=check_slug)
     service = None
     if service_slug:
-        service = Service.objects.get(slug=service_slug)
+        service = Service.objects.select_related("source").get(slug=service_slug)
 
     if check.limit == "none" and service is not None:
         raise ValueError("You cannot send a service to a check that has no services defined.")
@@ -61,7 +63,7 @@ def send_to_github(check_slug, service_slug=None):
     result = CheckResult.objects.create(health_check=check, status="sent", service=service)
 
     try:
-        send.dispatch(result)
+        send.dispatch(result, serialized)
     except (SendError, NoRepository) as error:
         # Fatal error, they are all going to fail.
         # Should we log here?
@@ -70,26 +72,142 @@ def send_to_github(check_slug, service_slug=None):
         raise error
 
 
+@app.task
+def send_batch_to_github(check_slug, service_slugs, serialized=None):
+    """Send the check for all the services to GitHub together, in one repository dispatch."""
+    check = Check.objects.get(slug=check_slug)
+    services = list(Service.objects.filter(slug__in=service_slugs).select_related("source"))
+    if not services:
+        return
+
+    # The results are created in bulk, so do what saving each one would have done.
+    results = CheckResult.objects.bulk_create(
+        [CheckResult(health_check=check, status="sent", service=service) for service in services]
+    )
+    bulk_log(LogEntry.Action.CREATE, [(None, result) for result in results])
+    summarise(services)
+    schedule.ran_services(check, services, timezone.now())
+
+    try:
+        send.dispatch_batch(check, results, serialized)
+    except (SendError, NoRepository) as error:
+        changes = []
+        for result in results:
+            old = copy.copy(result)
+            result.status = "error"
+            changes.append((old, result))
+        CheckResult.objects.bulk_update(results, ["status"])
+        bulk_log(LogEntry.Action.UPDATE, changes)
+        raise error
+
+
+def queue(check, services=None, serialized=None):
+    """
+    Queue sending the check to GitHub for the services, or without a service if there are
+    none. If the check has a batch size, the services are sent in batches of that size.
+
+    Pass `serialized` to serialize the check and the sources once for a sweep, rather than
+    in every task, see `serialize_for`.
+    """
+
+    def prepare(services):
+        if serialized is None:
+            return None
+        return serialize_for(check, services, serialized)
+
+    if services is None:
+        send_to_github.delay(check.slug, None, prepare([]))
+    elif check.batch_size > 1:
+        for start in range(0, len(services), check.batch_size):
+            batch = services[start : start + check.batch_size]
+            # Only the check is sent with a batch, not the sources.
+            send_batch_to_github.delay(check.slug, [service.slug for service in batch], prepare([]))
+    else:
+        for service in services:
+            send_to_github.delay(check.slug, service.slug, prepare([service]))
+
+
 @app.task
 def send_active_to_github():
-    check_queryset = Check.objects.filter(active=True)
-    for check in check_queryset:
-        services = check.get_services()
-        if services is None:
-            if should_run(check):
-                send_to_github.delay(check.slug)
-        else:
-            for service in services:
-                if should_run(check, service):
-                    send_to_github.delay(check.slug, service.slug)
+    """
+    Send the checks that are due, in batches. The schedules are moved on as they are sent,
+    so that the next run of this doesn't send them again before their results come in.
+    """
+    now = timezone.now()
+    # The checks and sources are serialized once for the sweep, not for each service.
+    serialized = {}
+    while True:
+        with transaction.atomic():
+            batch = list(
+                CheckSchedule.objects.filter(next_run_at__lte=now, health_check__active=True)
+                .select_related("health_check", "service__source")
+                .order_by("next_run_at")
+                .select_for_update(skip_locked=True, of=("self",))[:batch_size]
+            )
+            due = []
+            for row in batch:
+                try:
+                    row.next_run_at = schedule.next_run(row.health_check, now, now)
+                except Exception:
+                    # Don't let one check stop the others being sent, skip it for a while.
+                    logger.exception(f"Unable to schedule check: {row.health_check.slug}")
+                    row.next_run_at = now + retry_after
+                else:
+                    due.append(row)
+            CheckSchedule.objects.bulk_update(batch, ["next_run_at"])
+
+        checks, services = {}, defaultdict(list)
+        for row in due:
+            if row.service is None:
+                queue(row.health_check, serialized=serialized)
+            else:
+                checks[row.health_check_id] = row.health_check
+                services[row.health_check_id].append(row.service)
+        for pk, check in checks.items():
+            queue(check, services[pk], serialized)
+
+        if len(batch) < batch_size:
+            return
 
 
 @app.task
-def timeout(ago):
-    check_queryset = CheckResult.objects.filter(
-        updated__lt=timezone.now() - timedelta(hours=ago),
-        status__in=["sent"],
-    )
-    for check in check_queryset:
-        check.status = "timed-out"
-        check.save()
+def timeout(ago=None):
+    """
+    Mark results that have been waiting for a response for longer than `ago` hours, or
+    the CHECKS_TIMEOUT_HOURS setting, as timed out. This is done in batches in order of
+    the primary key, with one update for each batch.
+    """
+    if ago is None:
+        ago = settings.CHECKS_TIMEOUT_HOURS
+    cutoff = timezone.now() - timedelta(hours=ago)
+
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                CheckResult.objects.filter(pk__gt=last_pk, status="sent", updated__lt=cutoff)
+                .order_by("pk")
+                .select_for_update(skip_locked=True)[:timeout_batch_size]
+            )
+            if not batch:
+                return
+
+            now = timezone.now()
+            CheckResult.objects.filter(pk__in=[result.pk for result in batch]).update(
+                status="timed-out", updated=now
+            )
+            # The results are updated in bulk, so do what saving each one would have done.
+            changes = []
+            for result in batch:
+                old = copy.copy(result)
+                result.status, result.updated = "timed-out", now
+                changes.append((old, result))
+            bulk_log(LogEntry.Action.UPDATE, changes)
+
+        services = {result.service_id for result in batch if result.service_id is not None}
+        if services:
+            summarise(Service.objects.filter(pk__in=services))
+
+        if len(batch) < timeout_batch_size:
+            return
+        last_pk = batch[-1].pk
@@ -1,6 +1,7 @@
 from datetime import timedelta
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
+from auditlog.models import LogEntry
 from django.urls import reverse
 from django.utils import timezone
 from faker import Faker
@@ -9,8 +10,10 @@ from catalog.errors import FileAlreadyExists, NoRepository
 from catalog.tests import BaseTestCase
 from services.tests import create_service, create_source
 
+from . import schedule
 from .forms import CheckForm
-from .models import Check, CheckResult
+from .models import Check, CheckResult, CheckSchedule, ServiceHealthSummary, summarise
+from .serializers import CheckSerializer
 from .tasks import send_active_to_github, should_run, timeout
 
 fake = Faker()
@@ -259,6 +262,32 @@ class TestSend(WithHealthCheck):
             self.assertEqual(result.status, "sent")
             self.assertEqual(result.result, "unknown")
 
+    @patch("gh.send.send_to_repo")
+    @patch("gh.send.get_repo_installation")
+    def test_send_serialized_once(self, mock_repo, mock_send_to_repo):
+        """The check is serialized once in a sweep, however many services it's sent for"""
+        create_service(self.source)
+        with self.settings(
+            CELERY_TASK_ALWAYS_EAGER=True, GITHUB_CHECK_REPOSITORY="https://github.com/foo/bar"
+        ):
+            with patch("gh.send.CheckSerializer", wraps=CheckSerializer) as serializer:
+                send_active_to_github()
+        self.assertEqual(mock_send_to_repo.call_count, 2)
+        self.assertEqual(serializer.call_count, 1)
+
+    @patch("health.tasks.send")
+    def test_send_unschedulable(self, mock_send):
+        """A check that can't be scheduled doesn't stop the others being sent"""
+        check = Check.objects.create(name=fake.name(), frequency="cron", cron="0 9 * * *")
+        # This can't be saved normally, since it never runs.
+        Check.objects.filter(pk=check.pk).update(cron="0 9 31 2 *")
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True):
+            send_active_to_github()
+        self.assertEqual(mock_send.dispatch.call_count, 1)
+        self.assertEqual(CheckResult.objects.get().health_check, self.health_check)
+        row = CheckSchedule.objects.get(health_check=check)
+        self.assertGreater(row.next_run_at, timezone.now())
+
     @patch("health.tasks.send")
     def test_send_some_but_none_selected(self, mock_send):
         """Test sends one"""
@@ -333,6 +362,35 @@ class TestSend(WithHealthCheck):
             send_active_to_github()
         self.assertEqual(mock_send.dispatch.call_count, 0)
 
+    @patch("health.tasks.send")
+    def test_send_batch(self, mock_send):
+        """Test that a check with a batch size sends the services together"""
+        create_service(self.source)
+        create_service(self.source)
+        self.health_check.batch_size = 2
+        self.health_check.save()
+
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True):
+            send_active_to_github()
+        # 3 Services, in batches of 2, means 2 calls.
+        self.assertEqual(mock_send.dispatch_batch.call_count, 2)
+        mock_send.dispatch.assert_not_called()
+        self.assertEqual(CheckResult.objects.filter(status="sent").count(), 3)
+        self.assertEqual(LogEntry.objects.get_for_model(CheckResult).count(), 3)
+        self.assertFalse(CheckSchedule.objects.filter(next_run_at__lte=timezone.now()).exists())
+
+    @patch("health.tasks.send")
+    def test_send_batch_error(self, mock_send):
+        """Test that all the results in a batch are errors if it can't be sent"""
+        create_service(self.source)
+        self.health_check.batch_size = 2
+        self.health_check.save()
+        mock_send.dispatch_batch.side_effect = NoRepository("Nope")
+
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True):
+            send_active_to_github()
+        self.assertEqual(CheckResult.objects.filter(status="error").count(), 2)
+
     @patch("health.tasks.send")
     def test_ignore_adhoc(self, mock_send):
         """Test that it will adhoc checks"""
@@ -343,6 +401,101 @@ class TestSend(WithHealthCheck):
         self.assertEqual(mock_send.dispatch.call_count, 0)
 
 
+class TestSchedule(WithHealthCheck):
+    def due(self):
+        return {
+            (row.health_check.slug, row.service.slug if row.service else None)
+            for row in CheckSchedule.objects.filter(next_run_at__lte=timezone.now())
+        }
+
+    def test_reschedule(self):
+        """Test that the due schedules match should_run for every check and service"""
+        other = create_service(self.source)
+        hourly = Check.objects.create(name=fake.name(), frequency="hourly")
+        some = Check.objects.create(name=fake.name(), limit="some")
+        some.services.add(other)
+        none = Check.objects.create(name=fake.name(), limit="none")
+        Check.objects.create(name=fake.name(), frequency="ad-hoc")
+
+        CheckResult.objects.create(health_check=self.health_check, service=self.service)
+        CheckResult.objects.create(health_check=hourly, service=self.service)
+        CheckResult.objects.update(created=timezone.now() - timedelta(hours=2))
+        CheckResult.objects.create(health_check=none)
+
+        with self.assertNumQueries(9):
+            schedule.reschedule(checks=Check.objects.all())
+        expected = {
+            (self.health_check.slug, other.slug),
+            (hourly.slug, self.service.slug),
+            (hourly.slug, other.slug),
+            (some.slug, other.slug),
+        }
+        self.assertEqual(self.due(), expected)
+        for check in Check.objects.filter(limit__in=["all", "some"]):
+            for service in check.get_services():
+                due = (check.slug, service.slug) in expected
+                self.assertEqual(should_run(check, service, quiet=True), due)
+
+    def test_result_moves_schedule(self):
+        """Test that a result moves the schedule on by the frequency"""
+        result = CheckResult.objects.create(health_check=self.health_check, service=self.service)
+        row = CheckSchedule.objects.get()
+        self.assertEqual(row.next_run_at, result.created + timedelta(days=1))
+
+    def test_cron(self):
+        """Test that a cron check is next run at the next time that matches"""
+        self.health_check.frequency = "cron"
+        self.health_check.cron = "30 9 * * *"
+        self.health_check.save()
+        result = CheckResult.objects.create(health_check=self.health_check, service=self.service)
+
+        next_run_at = CheckSchedule.objects.get().next_run_at
+        self.assertEqual((next_run_at.hour, next_run_at.minute), (9, 30))
+        self.assertGreater(next_run_at, result.created)
+        self.assertLessEqual(next_run_at - result.created, timedelta(days=1))
+
+    def test_cron_invalid(self):
+        """Test that a cron check needs a valid cron expression"""
+        data = {"name": fake.name(), "frequency": "cron", "limit": "all", "cron": "* *"}
+        self.assertFalse(CheckForm(data).is_valid())
+        data["cron"] = "0 9 31 2 *"
+        self.assertFalse(CheckForm(data).is_valid())
+        data["cron"] = "0 9 * * 1-5"
+        self.assertTrue(CheckForm(data).is_valid())
+
+    def test_changes(self):
+        """Test that schedules follow changes to checks and services"""
+        other = create_service(self.source)
+        self.assertEqual(CheckSchedule.objects.count(), 2)
+
+        self.health_check.limit = "some"
+        self.health_check.save()
+        self.assertEqual(CheckSchedule.objects.count(), 0)
+        self.health_check.services.add(other)
+        self.assertEqual(list(CheckSchedule.objects.values_list("service", flat=True)), [other.pk])
+
+        self.health_check.limit = "all"
+        self.health_check.save()
+        other.active = False
+        other.save()
+        self.assertEqual(
+            list(CheckSchedule.objects.values_list("service", flat=True)), [self.service.pk]
+        )
+
+        self.health_check.active = False
+        self.health_check.save()
+        self.assertEqual(CheckSchedule.objects.count(), 0)
+
+    @patch("health.tasks.send_to_github")
+    def test_send_due(self, mock_send):
+        """Test that only due schedules are sent, and they are moved on"""
+        other = create_service(self.source)
+        CheckResult.objects.create(health_check=self.health_check, service=self.service)
+        send_active_to_github()
+        mock_send.delay.assert_called_once_with(self.health_check.slug, other.slug, ANY)
+        self.assertEqual(self.due(), set())
+
+
 class TestSendFrequency(WithHealthCheck):
     def test_send_if_not_run(self):
         """Test that it will send if not run"""
@@ -367,6 +520,10 @@ class TestSendFrequency(WithHealthCheck):
         CheckResult.objects.update(created=timezone.now() - timedelta(seconds=60 * 60 + 1))
         assert should_run(self.health_check, self.service)
 
+        # More than a day ago, but less than an hour past a whole day.
+        CheckResult.objects.update(created=timezone.now() - timedelta(days=1, minutes=10))
+        assert should_run(self.health_check, self.service)
+
     def test_send_if_weekly(self):
         """Test that it will send if weekly"""
         self.health_check.frequency = "weekly"
@@ -399,6 +556,64 @@ class TestResultModel(WithHealthCheck):
         self.assertRaises(ValueError, result.save)
 
 
+class TestHealthSummary(WithHealthCheck):
+    def get_summary(self):
+        return ServiceHealthSummary.objects.get(service=self.service)
+
+    def test_result_saved(self):
+        """The summary follows the latest result as it is saved."""
+        result = create_health_check_result(self.health_check, self.service)
+        self.assertEqual(self.get_summary().state, "failing")
+        result.result = "pass"
+        result.save()
+        summary = self.get_summary()
+        self.assertEqual(summary.state, "passing")
+        self.assertEqual(summary.results[str(self.health_check.pk)]["id"], result.pk)
+
+    def test_check_activated(self):
+        """Adding or deactivating a check changes the summary."""
+        create_health_check_result(self.health_check, self.service, result="pass")
+        other = Check.objects.create(name=fake.name())
+        self.assertEqual(self.get_summary().state, "failing")
+        other.active = False
+        other.save()
+        self.assertEqual(self.get_summary().state, "passing")
+
+    def test_check_deleted(self):
+        """Deleting the only check means nothing has been run."""
+        create_health_check_result(self.health_check, self.service, result="pass")
+        self.health_check.delete()
+        self.assertEqual(self.get_summary().state, "not-run")
+
+    def test_result_deleted(self):
+        """Deleting a result through the API falls back to the previous one."""
+        first = create_health_check_result(self.health_check, self.service, result="pass")
+        latest = create_health_check_result(self.health_check, self.service, result="fail")
+        self.assertEqual(self.get_summary().state, "failing")
+        self.add_to_members()
+        self.api_login()
+        url = reverse("health:api-result-detail", args=[latest.pk])
+        self.assertEqual(self.api_client.delete(url).status_code, 204)
+        summary = self.get_summary()
+        self.assertEqual(summary.state, "passing")
+        self.assertEqual(summary.results[str(self.health_check.pk)]["id"], first.pk)
+
+    def test_summarise_all(self):
+        """Summarising with no services, covers all of them."""
+        other = create_service(self.source)
+        summarise()
+        self.assertEqual(ServiceHealthSummary.objects.count(), 2)
+        self.assertEqual(ServiceHealthSummary.objects.get(service=other).state, "not-run")
+
+    def test_api(self):
+        """The health of the service is included in the API."""
+        create_health_check_result(self.health_check, self.service, result="pass")
+        self.add_to_members()
+        self.api_login()
+        url = reverse("services:api-service-detail", kwargs={"pk": self.service.pk})
+        self.assertEqual(self.api_client.get(url).json()["health"], "passing")
+
+
 class TestTimeout(WithHealthCheck):
     def setUp(self):
         super().setUp()
@@ -418,6 +633,86 @@ class TestTimeout(WithHealthCheck):
             timeout(ago=11)
             self.assertEquals(CheckResult.objects.filter(status="timed-out").count(), 1)
 
+    def test_timeout_setting(self):
+        """Timeouts results older than the setting, in batches, logging each one."""
+        other = create_service(self.source)
+        results = [
+            create_health_check_result(self.health_check, service)
+            for service in [self.service, other]
+        ]
+        recent = create_health_check_result(self.health_check, self.service)
+        CheckResult.objects.exclude(pk=recent.pk).update(
+            updated=timezone.now() - timedelta(hours=4)
+        )
+
+        with self.settings(CHECKS_TIMEOUT_HOURS=3), patch("health.tasks.timeout_batch_size", 1):
+            timeout()
+
+        self.assertEqual(
+            set(CheckResult.objects.filter(status="timed-out").values_list("pk", flat=True)),
+            {result.pk for result in results},
+        )
+        self.assertEqual(CheckResult.objects.get(pk=recent.pk).status, "sent")
+        entries = LogEntry.objects.get_for_model(CheckResult).filter(action=LogEntry.Action.UPDATE)
+        self.assertEqual(entries.count(), 2)
+        self.assertEqual(entries.first().changes_dict["status"], ["sent", "timed-out"])
+        summary = ServiceHealthSummary.objects.get(service=other)
+        self.assertEqual(summary.results[str(self.health_check.pk)]["status"], "timed-out")
+
+
+class TestResultBatch(WithHealthCheck):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("health:api-result-batch")
+        self.other = create_service(self.source)
+        self.results = [
+            create_health_check_result(self.health_check, service)
+            for service in [self.service, self.other]
+        ]
+
+    def test_update(self):
+        """Test that many results can be sent back at once"""
+        self.api_login()
+        self.add_to_members()
+        data = {
+            "results": [
+                {"id": self.results[0].pk, "result": "pass", "message": "All good"},
+                {"id": self.results[1].pk, "result": "fail"},
+            ]
+        }
+        response = self.api_client.post(self.url, data, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated"], [result.pk for result in self.results])
+
+        first, second = [CheckResult.objects.get(pk=result.pk) for result in self.results]
+        self.assertEqual(
+            (first.result, first.message, first.status), ("pass", "All good", "completed")
+        )
+        self.assertEqual((second.result, second.status), ("fail", "completed"))
+        self.assertEqual(ServiceHealthSummary.objects.get(service=self.service).state, "passing")
+        self.assertEqual(ServiceHealthSummary.objects.get(service=self.other).state, "failing")
+        self.assertEqual(LogEntry.objects.get_for_object(first).count(), 2)
+
+        # Sending the batch again doesn't change the completed results.
+        data["results"][0]["result"] = "fail"
+        response = self.api_client.post(self.url, data, format="json")
+        self.assertEqual(response.json()["updated"], [])
+        self.assertEqual(len(response.json()["errors"]), 2)
+        self.assertEqual(CheckResult.objects.get(pk=first.pk).result, "pass")
+
+    def test_invalid(self):
+        """Test that an invalid result is rejected"""
+        self.api_login()
+        self.add_to_members()
+        data = {"results": [{"id": self.results[0].pk, "result": "nope"}]}
+        response = self.api_client.post(self.url, data, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CheckResult.objects.get(pk=self.results[0].pk).result, "unknown")
+
+    def test_anonymous(self):
+        response = self.api_client.post(self.url, {"results": []}, format="json")
+        self.assertEqual(response.status_code, 401)
+
 
 class TestAdHoc(WithHealthCheck):
     def setUp(self):
@@ -19,6 +19,7 @@ urlpatterns = [
     path("health/<str:slug>/run/", views.checks_run, name="checks-run"),
     path("results/", views.results, name="results-list"),
     path("results/<pk>/detail/", views.results_detail, name="results-detail"),
+    path("api/results/batch/", views.api_results_batch, name="api-result-batch"),
     path("api/", include(router.urls)),
     path("api/health/<pk>/run/", views.api_checks_run, name="api-checks-run"),
 ]
@@ -1,3 +1,4 @@
+import copy
 from collections import Counter
 from distutils.util import strtobool
 
@@ -6,16 +7,19 @@ from auditlog.models import LogEntry
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
+from django.db import transaction
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
+from django.utils import timezone
 from django.views.decorators.http import require_POST
-from rest_framework import permissions, viewsets
+from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
 from catalog.errors import FileAlreadyExists
 from gh import create, fetch
 from services.models import Service
+from systemlogs.bulk import bulk_log
 from web.helpers import YES_NO_CHOICES, paginate
 
 from .forms import ActionForm, CheckForm
@@ -25,9 +29,14 @@ from .models import (
     STATUS_CHOICES,
     Check,
     CheckResult,
+    summarise,
 )
-from .serializers import CheckResultSerializer, CheckSerializer
-from .tasks import send_to_github
+from .serializers import (
+    CheckResultBatchSerializer,
+    CheckResultSerializer,
+    CheckSerializer,
+)
+from .tasks import queue
 
 
 class CheckFilter(django_filters.FilterSet):
@@ -148,10 +157,9 @@ def checks_delete(request, slug):
 def send(check):
     services = check.get_services()
     if services is None:
-        send_to_github.delay(check.slug)
+        queue(check, serialized={})
     else:
-        for service in services:
-            send_to_github.delay(check.slug, service.slug)
+        queue(check, list(services.select_related("source")), serialized={})
 
 
 # Sending a check is essentially asking something to change it
@@ -169,10 +177,64 @@ def checks_run(request, slug):
 @permission_required("health.change_check")
 def api_checks_run(request, pk):
     check = get_object_or_404(Check, pk=pk)
-    send(request.user.username, check)
+    send(check)
     return Response({"success": True})
 
 
+@api_view(["POST"])
+@permission_required("health.change_checkresult")
+def api_results_batch(request):
+    """
+    Update many check results at once, passed as `results`, a list of objects with the
+    `id`, `result` and optionally the `message` of each. This is how an Action that was
+    sent a batch of results sends them back. Results that have already been completed
+    are skipped and returned in `errors`, so a batch can be sent again safely.
+    """
+    data = request.data.get("results") if isinstance(request.data, dict) else None
+    serializer = CheckResultBatchSerializer(data=data, many=True)
+    if not serializer.is_valid():
+        return Response(
+            {"success": False, "errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    items = {item["id"]: item for item in serializer.validated_data}
+    results = CheckResult.objects.select_related("service").in_bulk(list(items.keys()))
+
+    now = timezone.now()
+    changes, errors = [], {}
+    for pk, item in items.items():
+        result = results.get(pk)
+        if result is None:
+            errors[pk] = "Not found."
+            continue
+        if result.status == "completed":
+            errors[pk] = "Cannot alter a completed check result."
+            continue
+
+        old = copy.copy(result)
+        result.result = item["result"]
+        result.message = item.get("message", result.message)
+        # The same as saving the result would do.
+        if result.result != "unknown" and result.status == "sent":
+            result.status = "completed"
+        result.updated = now
+        changes.append((old, result))
+
+    updated = [result for _, result in changes]
+    with transaction.atomic():
+        CheckResult.objects.bulk_update(updated, ["result", "message", "status", "updated"])
+        bulk_log(LogEntry.Action.UPDATE, changes)
+        summarise({result.service for result in updated if result.service is not None})
+
+    return Response(
+        {
+            "success": not errors,
+            "updated": [result.pk for result in updated],
+            "errors": errors,
+        }
+    )
+
+
 class CheckResultFilter(django_filters.FilterSet):
     class Meta:
         model = CheckResult
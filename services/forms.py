@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from urllib.parse import urlparse
@@ -5,7 +6,6 @@ from urllib.parse import urlparse
 import jsonschema
 from django import forms
 from django.conf import settings
-from django.contrib import messages
 
 from gh.fetch import url_to_nwo, url_to_org
 from web.shortcuts import get_object_or_None
@@ -57,34 +57,66 @@ class SourceForm(forms.ModelForm, BaseForm):
         return res
 
 
+# The schema and the validator compiled from it, shared by everything in this process.
+_compiled = {"path": None, "mtime": None, "hash": None, "schema": None, "validator": None}
+
+
+def get_validator():
+    """
+    Return the validator for the service schema. The schema file is only read again when
+    its modification time changes and the validator is only rebuilt when its contents do.
+    """
+    path = settings.SERVICE_SCHEMA
+    if not os.path.exists(path):
+        raise ValueError(f"No schema file found at: {path}")
+
+    mtime = os.stat(path).st_mtime_ns
+    if _compiled["path"] == path and _compiled["mtime"] == mtime:
+        return _compiled["validator"]
+
+    with open(path, "rb") as schema_file:
+        contents = schema_file.read()
+    digest = hashlib.sha256(contents).hexdigest()
+    if _compiled["path"] != path or _compiled["hash"] != digest:
+        schema = json.loads(contents)
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        _compiled.update({"schema": schema, "validator": cls(schema), "hash": digest})
+
+    _compiled.update({"path": path, "mtime": mtime})
+    return _compiled["validator"]
+
+
 def get_schema():
-    if not os.path.exists(settings.SERVICE_SCHEMA):
-        raise ValueError(f"No schema file found at: {settings.SERVICE_SCHEMA}")
+    get_validator()
+    return _compiled["schema"]
+
 
-    with open(settings.SERVICE_SCHEMA, "r") as schema_file:
-        return json.load(schema_file)
+def validate_data(data):
+    """Returns the best error message for the data, or None if it matches the schema."""
+    error = jsonschema.exceptions.best_match(get_validator().iter_errors(data))
+    return error.message if error else None
 
 
 class ServiceForm(forms.Form, BaseForm):
     data = forms.CharField()
 
     def clean_data(self):
-        schema = get_schema()
         try:
-            jsonschema.validate(self.data["data"], schema)
+            error = validate_data(self.data["data"])
         except json.JSONDecodeError:
             raise forms.ValidationError("Unable to decode the JSON.")
-        except jsonschema.ValidationError as error:
-            raise forms.ValidationError(error.message)
+        if error:
+            raise forms.ValidationError(error)
 
         self.data["slug"] = models.slugify_service(self.data["data"]["name"])
         return self.data["data"]
 
     def save(self):
         """
-        This does all the heavy lifting for saving a service.
-        It will create a new service if it does not exist, or update an existing service if it does exist.
-        It will also add and remove dependencies as needed.
+        Create the service if it does not exist, or update it if it does exist. It will
+        also add and remove dependencies as needed. See `services.ingest` for saving all the
+        files from a source at once.
 
         It will require the source to be set on the form before calling save.
         Returns:
@@ -95,64 +127,14 @@ class ServiceForm(forms.Form, BaseForm):
                 "logs": list
             }
         """
-        logs = []
-        created = False
-        updated = False
-        assert self.source, "Source must be set on the form."
-        data = self.data["data"]
-        slug = models.slugify_service(data["name"])
-        try:
-            service = models.Service.objects.get(slug=slug)
-            for key in ["name", "description", "type", "priority", "meta", "active", "events"]:
-                if data.get(key) != getattr(service, key, None):
-                    value = data.get(key)
-                    if key == "active" and not value:
-                        value = True
-                    setattr(service, key, value)
-                    updated = True
-            service.raw_data = data
-            if updated:
-                service.save()
-                logs.append([f"Updated service: `{service}`.", messages.INFO])
-
-        except models.Service.DoesNotExist:
-            service = models.Service.objects.create(
-                name=data["name"],
-                description=data.get("description"),
-                type=data.get("type"),
-                priority=data["priority"],
-                meta=data.get("meta"),
-                source=self.source,
-                active=data.get("active", True),
-                events=data.get("events", []),
-                raw_data=data,
-            )
-            created = True
-            logs.append([f"Created service: `{service}`.", messages.INFO])
-
-        if "dependencies" in data:
-            for dependency in data["dependencies"]:
-                try:
-                    dependency = models.Service.objects.get(slug=dependency)
-                except models.Service.DoesNotExist:
-                    logs.append(
-                        [
-                            f"Dependency: `{dependency}` does not exist in the catalog and was not connected.",
-                            messages.WARNING,
-                        ]
-                    )
-                    continue
-                service.dependencies.add(dependency)
-
-        # Remove any depenedencies that are not in the catalog data.
-        for dependency in service.dependencies.all():
-            if dependency.slug not in data["dependencies"]:
-                logs.append([f"Removed dependency `{dependency}`.", messages.INFO])
-                service.dependencies.remove(dependency)
+        from .ingest import upsert
 
+        assert self.source, "Source must be set on the form."
+        result = upsert(self.source, [self.data["data"]])
+        service = result["services"][0]
         return {
-            "created": created,
+            "created": service in result["created"],
             "service": service,
-            "updated": updated,
-            "logs": logs,
+            "updated": service in result["updated"],
+            "logs": result["logs"],
         }
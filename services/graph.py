@@ -0,0 +1,112 @@
+import uuid
+from collections import defaultdict, deque
+
+from django.core.cache import cache
+
+from .models import Service
+
+version_key = "services:graph:version"
+
+# The last graph loaded by this process, so it's not unpickled from the cache every time.
+_loaded = {"version": None, "graph": None}
+
+
+class DependencyGraph:
+    """
+    All the dependencies between services, loaded in one query. This allows questions
+    that need more than one hop through the dependencies to be answered in memory,
+    instead of going back to the database for each service.
+
+    Services are referred to by their pk.
+    """
+
+    def __init__(self, edges):
+        self.dependencies = defaultdict(set)
+        self.dependents = defaultdict(set)
+        for service, dependency in edges:
+            self.dependencies[service].add(dependency)
+            self.dependents[dependency].add(service)
+
+    @classmethod
+    def load(cls):
+        through = Service.dependencies.through
+        return cls(through.objects.values_list("from_service_id", "to_service_id"))
+
+    def walk(self, start, edges):
+        """
+        A breadth first walk from the start, returning the distance to every service that
+        can be reached. Cycles are only visited once.
+        """
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for neighbour in edges.get(current, ()):
+                if neighbour not in distances:
+                    distances[neighbour] = distances[current] + 1
+                    queue.append(neighbour)
+        del distances[start]
+        return distances
+
+    def transitive_dependencies(self, service):
+        """Everything the service depends on, directly or not, with the distance to each."""
+        return self.walk(service, self.dependencies)
+
+    def transitive_dependents(self, service):
+        """Everything that depends on the service, directly or not, with the distance to each."""
+        return self.walk(service, self.dependents)
+
+    def depth(self, service):
+        """How many hops away the furthest dependency of the service is."""
+        return max(self.transitive_dependencies(service).values(), default=0)
+
+    def path(self, start, end):
+        """
+        The shortest path from the start to the end following the dependencies, including
+        both ends. Returns None if the start does not depend on the end.
+        """
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            if current == end:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = previous[current]
+                return path[::-1]
+
+            for neighbour in self.dependencies.get(current, ()):
+                if neighbour not in previous:
+                    previous[neighbour] = current
+                    queue.append(neighbour)
+        return None
+
+
+def get_graph():
+    """
+    Return the dependency graph, from the cache if the dependencies have not changed
+    since it was last loaded.
+    """
+    version = cache.get(version_key)
+    if version is None:
+        version = invalidate()
+
+    if _loaded["version"] == version:
+        return _loaded["graph"]
+
+    key = f"services:graph:{version}"
+    graph = cache.get(key)
+    if graph is None:
+        graph = DependencyGraph.load()
+        cache.set(key, graph, 60 * 60 * 24)
+
+    _loaded.update({"version": version, "graph": graph})
+    return graph
+
+
+def invalidate():
+    """Mark the graph as out of date, call this when the dependencies change."""
+    version = uuid.uuid4().hex
+    cache.set(version_key, version, None)
+    return version
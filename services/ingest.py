@@ -0,0 +1,256 @@
+import copy
+from collections import defaultdict
+
+from auditlog.models import LogEntry
+from django.contrib import messages
+from django.db import transaction
+from django.utils import timezone
+
+from health import schedule
+from systemlogs.bulk import bulk_log
+
+from . import graph
+from .forms import ServiceForm
+from .models import Service, Source, slugify_service
+
+# The fields that are copied straight from the catalog file on to the service.
+fields = ["name", "description", "type", "priority", "meta", "active", "events"]
+# The values used when a field is not in the catalog file, for both creates and updates.
+defaults = {"active": True, "events": []}
+
+
+def ingest(source, results):
+    """
+    Take all the files returned by `gh.fetch.get` for a source, validate them and then
+    create, update and connect all the services in them in bulk.
+
+    If any file fails validation, nothing is changed.
+    Returns:
+        dict: {
+            "errors": list,
+            "created": list,
+            "updated": list,
+            "services": list,
+            "logs": list
+        }
+    """
+    return ingest_many([(source, results)])[source.pk]
+
+
+def ingest_many(batch):
+    """
+    Ingest the files for more than one source at once, from a list of (source, results).
+
+    This is done in two phases, first every service in every source is created or updated
+    and then all the dependencies are connected in one pass. So a service can depend on
+    a service in another file or another source, no matter what order they come in.
+
+    A source with an invalid file is skipped, the others are still ingested.
+    Returns a dict of the source pk to the same result `ingest` returns.
+    """
+    outcome, valid = {}, []
+    for source, results in batch:
+        documents, errors = validate(results)
+        if errors:
+            outcome[source.pk] = {"errors": errors, **empty()}
+            continue
+        valid.append((source, documents, [data.get("path") for data in results]))
+
+    pending, by_slug = [], {}
+    with transaction.atomic():
+        for source, documents, paths in valid:
+            result, source_slugs = upsert_nodes(source, documents, paths)
+            pending.append((source, result))
+            by_slug.update(source_slugs)
+
+        services = [service for _, result in pending for service in result["services"]]
+        logs = link(services, by_slug)
+        link_waiting([service for _, result in pending for service in result["created"]], services)
+
+    now = timezone.now()
+    for source, result in pending:
+        add_link_logs(result, logs)
+        source.updated = now
+        outcome[source.pk] = {"errors": [], **result}
+    Source.objects.filter(pk__in=[source.pk for source, _ in pending]).update(updated=now)
+    return outcome
+
+
+def validate(results):
+    """Returns the documents in the results and the errors, stopping at the first error."""
+    documents = []
+    for data in results:
+        form = ServiceForm({"data": data["contents"]})
+        if not form.is_valid():
+            return [], [form.nice_errors()]
+        documents.append(form.data["data"])
+    return documents, []
+
+
+def empty():
+    return {"created": [], "updated": [], "services": [], "logs": []}
+
+
+def upsert(source, documents):
+    """
+    Create or update the services from the validated documents and connect their
+    dependencies, with a fixed number of queries no matter how many documents or
+    dependencies there are.
+    """
+    with transaction.atomic():
+        result, by_slug = upsert_nodes(source, documents)
+        logs = link(result["services"], by_slug)
+        link_waiting(result["created"], result["services"])
+    add_link_logs(result, logs)
+    return result
+
+
+def add_link_logs(result, logs):
+    for service in result["services"]:
+        result["logs"].extend(logs.get(service.slug, []))
+
+
+def upsert_nodes(source, documents, paths=None):
+    """
+    Create or update the services from the validated documents, without touching the
+    dependencies. The paths are the files in the source each document came from, if known.
+    Returns the result and the documents by the slug of the service.
+    """
+    result = empty()
+    if not documents:
+        return result, {}
+
+    # If more than one document has the same name, the last one wins.
+    by_slug, file_paths = {}, {}
+    for data, path in zip(documents, paths or [None] * len(documents)):
+        slug = slugify_service(data["name"])
+        by_slug[slug] = data
+        file_paths[slug] = path
+
+    now = timezone.now()
+    existing = Service.objects.select_related("source").in_bulk(
+        list(by_slug.keys()), field_name="slug"
+    )
+    created, updated = [], []
+    for slug, data in by_slug.items():
+        service = existing.get(slug)
+        if service is None:
+            service = Service(
+                name=data["name"],
+                slug=slug,
+                description=data.get("description"),
+                type=data.get("type"),
+                priority=data["priority"],
+                meta=data.get("meta"),
+                source=source,
+                path=file_paths[slug] or "",
+                active=data.get("active", defaults["active"]),
+                events=data.get("events", defaults["events"]),
+                raw_data=data,
+            )
+            created.append(service)
+            result["logs"].append([f"Created service: `{service}`.", messages.INFO])
+
+        else:
+            old = copy.copy(service)
+            changed = False
+            for key in fields:
+                value = data.get(key, defaults.get(key))
+                if value != getattr(service, key, None):
+                    setattr(service, key, value)
+                    changed = True
+            if file_paths[slug] is not None and file_paths[slug] != service.path:
+                service.path = file_paths[slug]
+                changed = True
+            if changed:
+                service.raw_data = data
+                service.updated = now
+                updated.append((old, service))
+                result["logs"].append([f"Updated service: `{service}`.", messages.INFO])
+
+        result["services"].append(service)
+
+    Service.objects.bulk_create(created)
+    Service.objects.bulk_update(
+        [service for _, service in updated], fields + ["path", "raw_data", "updated"]
+    )
+    bulk_log(LogEntry.Action.CREATE, [(None, service) for service in created])
+    bulk_log(LogEntry.Action.UPDATE, updated)
+
+    # New, activated and deactivated services change which checks run against them.
+    scheduled = created + [service for old, service in updated if old.active != service.active]
+    if scheduled:
+        schedule.reschedule(services=scheduled)
+
+    result["created"] = created
+    result["updated"] = [service for _, service in updated]
+    return result, by_slug
+
+
+def link_waiting(created, services):
+    """
+    Connect the services that were ingested earlier, that depend on services that have
+    only just been created. For example when a refresh is split into more than one batch.
+    """
+    if not created:
+        return
+
+    waiting = list(
+        Service.objects.filter(
+            raw_data__dependencies__has_any_keys=[service.slug for service in created]
+        ).exclude(pk__in=[service.pk for service in services])
+    )
+    link(waiting, {service.slug: service.raw_data for service in waiting})
+
+
+def link(services, by_slug):
+    """
+    Make the dependencies of the services match the documents, adding and removing
+    the rows in the through table in bulk. Returns the logs by the slug of the service.
+    """
+    logs = defaultdict(list)
+    # The same service can be in more than one source, the last one wins.
+    services = {service.slug: service for service in services}.values()
+    if not services:
+        return logs
+
+    through = Service.dependencies.through
+    wanted_slugs = set()
+    for data in by_slug.values():
+        wanted_slugs.update(data.get("dependencies", []))
+    pks = dict(Service.objects.filter(slug__in=wanted_slugs).values_list("slug", "pk"))
+
+    wanted = set()
+    for service in services:
+        for dependency in by_slug[service.slug].get("dependencies", []):
+            if dependency not in pks:
+                logs[service.slug].append(
+                    [
+                        f"Dependency: `{dependency}` does not exist in the catalog and was not connected.",
+                        messages.WARNING,
+                    ]
+                )
+                continue
+            wanted.add((service.pk, pks[dependency]))
+
+    current = {}
+    for pk, from_pk, to_pk, from_slug, to_slug in through.objects.filter(
+        from_service__in=[service.pk for service in services]
+    ).values_list(
+        "pk", "from_service_id", "to_service_id", "from_service__slug", "to_service__slug"
+    ):
+        current[(from_pk, to_pk)] = (pk, from_slug, to_slug)
+
+    to_add = wanted - set(current)
+    to_remove = set(current) - wanted
+    for edge in to_remove:
+        _, from_slug, to_slug = current[edge]
+        logs[from_slug].append([f"Removed dependency `{to_slug}`.", messages.INFO])
+
+    through.objects.bulk_create(
+        [through(from_service_id=from_pk, to_service_id=to_pk) for from_pk, to_pk in to_add]
+    )
+    through.objects.filter(pk__in=[current[edge][0] for edge in to_remove]).delete()
+    if to_add or to_remove:
+        transaction.on_commit(graph.invalidate)
+    return logs
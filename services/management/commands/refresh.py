@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from services import models
-from services.tasks import refresh_source_from_github
+from services.tasks import schedule_refresh
 
 
 class Command(BaseCommand):
@@ -34,8 +34,7 @@ class Command(BaseCommand):
         if options.get("source"):
             queryset = models.Source.objects.filter(slug=options.get("source"))
 
-        for source in queryset:
-            refresh_source_from_github.delay(source.slug)
+        schedule_refresh(list(queryset.values_list("slug", flat=True)))
 
         if not quiet:
             print(f"Processed {queryset.count()} sources.")
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:54
+
+from urllib.parse import urlparse
+
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    Source = apps.get_model("services", "Source")
+    sources = list(Source.objects.only("url"))
+    for source in sources:
+        source.repository = urlparse(source.url).path.strip("/").lower()
+    Source.objects.bulk_update(sources, ["repository"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("services", "0008_alter_service_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="source",
+            name="repository",
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
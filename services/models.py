@@ -71,14 +71,7 @@ class Service(models.Model):
 
     def latest_results(self):
         """Return the latest results for a service."""
-        checks = Check.objects.filter(active=True)
-        results = CheckResult.objects.filter(service=self).order_by("created")
-        checks_with_results = []
-        for check in checks:
-            checks_with_results.append(
-                {"check": check, "last": results.filter(health_check=check).last()}
-            )
-        return checks_with_results
+        return latest_results([self])[self.pk]
 
 
 class Source(models.Model):
@@ -95,6 +88,9 @@ class Source(models.Model):
         unique=True,
     )
     slug = models.SlugField(max_length=255, unique=True)
+    # The "org/repo" part of the url in lower case, so that urls that GitHub considers the
+    # same, such as webhooks, can be looked up.
+    repository = models.CharField(max_length=255, blank=True, db_index=True, editable=False)
 
     active = models.BooleanField(default=True)
 
@@ -125,6 +121,7 @@ class Source(models.Model):
         if self.url.endswith("/"):
             self.url = self.url[:-1]
 
+        self.repository = repository_key(self.url)
         super().save(*args, **kwargs)
 
     def get_absolute_url(self):
@@ -161,6 +158,27 @@ class Organization(models.Model):
         super().save(*args, **kwargs)
 
 
+def latest_results(services):
+    """
+    Return the latest result of each active check for each of the services, keyed by the
+    service pk. This is one query for the checks and one for the results, no matter how
+    many services or checks there are, so it can be used for a whole page of services.
+    """
+    checks = list(Check.objects.filter(active=True))
+    results = (
+        CheckResult.objects.filter(service__in=services, health_check__in=checks)
+        .order_by("service", "health_check", "-created")
+        .distinct("service", "health_check")
+    )
+    latest = {(result.service_id, result.health_check_id): result for result in results}
+    return {
+        service.pk: [
+            {"check": check, "last": latest.get((service.pk, check.pk))} for check in checks
+        ]
+        for service in services
+    }
+
+
 def slugify_service(name):
     return slugify(name)
 
@@ -169,6 +187,11 @@ def slugify_source(url):
     return slugify(urlparse(url).path.replace("/", "-"))
 
 
+def repository_key(url):
+    """The key for the repository at the url, see `Source.repository`."""
+    return urlparse(url).path.strip("/").lower()
+
+
 auditlog.register(Organization)
 auditlog.register(Service)
 auditlog.register(Source)
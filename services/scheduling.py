@@ -0,0 +1,79 @@
+import time
+from collections import defaultdict
+
+from django.db.models import F, Min
+
+from gh import limits
+from gh.fetch import url_to_nwo
+
+from .models import Source
+
+# Roughly how many requests refreshing a source takes: the installation, the repository,
+# the tree and the files. Most files are cached, so this is on the high side.
+requests_per_source = 5
+# How much of the rate limit to keep back for everything else, such as sending checks.
+reserve = 0.2
+# The most sources to refresh in one task.
+chunk_size = 10
+
+
+def prioritise(source_slugs):
+    """
+    The sources in the order they should be refreshed: the ones with the highest priority
+    services first, then the ones that were refreshed the longest ago. Sources without
+    any services yet go first, since it's not known what's in them.
+    """
+    return (
+        Source.objects.filter(slug__in=source_slugs)
+        .annotate(priority=Min("services__priority"))
+        .order_by(F("priority").asc(nulls_first=True), "updated")
+    )
+
+
+def plan(sources):
+    """
+    Split the sources up into chunks that fit in the rate limit left for each org. The
+    chunks that fit in what's left of the current rate limit window are spread over it, the
+    rest are spread over the next window, up to a window from now. Room for the sources is
+    reserved in each window as they are planned, see `limits.reserve`.
+
+    Sources that don't fit are left out, for the next hourly refresh to pick up. Countdowns
+    longer than the broker's visibility timeout, an hour on Redis, are delivered twice.
+
+    Returns a list of (countdown in seconds, source slugs), in order.
+    """
+    by_org = defaultdict(list)
+    for source in sources:
+        org_name, _ = url_to_nwo(source.url)
+        by_org[org_name.lower()].append(source.slug)
+
+    now = int(time.time())
+    chunks = []
+    for org_name, slugs in by_org.items():
+        budget = limits.get_budget(org_name)
+        kept = int(budget["limit"] * reserve)
+        per_window = max((budget["limit"] - kept) // requests_per_source, 1)
+
+        # Starting with what's left of the current window, then the next one until a window
+        # from now.
+        available = max(budget["remaining"] - kept, 0) // requests_per_source
+        start, length, reset = 0, max(budget["reset"] - now, 0), budget["reset"]
+        while slugs and start < limits.window:
+            count = min(len(slugs), available)
+            if count:
+                count = limits.reserve(org_name, reset, count, available)
+            chunks.extend(spread(slugs[:count], start, min(length, limits.window - start)))
+            slugs = slugs[count:]
+            start, length = start + length, limits.window
+            reset, available = reset + limits.window, per_window
+
+    return sorted(chunks, key=lambda chunk: chunk[0])
+
+
+def spread(slugs, start, length):
+    """Split the slugs into chunks, spread evenly over `length` seconds from `start`."""
+    offsets = range(0, len(slugs), chunk_size)
+    return [
+        (start + index * length // len(offsets), slugs[offset : offset + chunk_size])
+        for index, offset in enumerate(offsets)
+    ]
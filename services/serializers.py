@@ -11,6 +11,8 @@ class SourceSerializer(serializers.ModelSerializer):
 
 
 class ServiceSerializer(serializers.ModelSerializer):
+    health = serializers.CharField(source="health.state", read_only=True)
+
     class Meta:
         model = Service
         fields = "__all__"
@@ -0,0 +1,20 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
+
+from . import graph
+from .models import Service
+
+
+# The graph is invalidated once the change is committed, otherwise it could be loaded
+# again with the old dependencies before then.
+def dependencies_changed_handler(sender, action, **kwargs):
+    if action in ["post_add", "post_remove", "post_clear"]:
+        transaction.on_commit(graph.invalidate)
+
+
+def service_deleted_handler(sender, instance, **kwargs):
+    transaction.on_commit(graph.invalidate)
+
+
+m2m_changed.connect(dependencies_changed_handler, sender=Service.dependencies.through)
+post_delete.connect(service_deleted_handler, sender=Service)
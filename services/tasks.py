@@ -1,10 +1,20 @@
+import copy
+import datetime
 import logging
 
+from auditlog.models import LogEntry
+from celery import chord
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
 from catalog.celery import app
 from catalog.errors import FetchError
 from gh import fetch
-from services import forms
-from services.models import Organization, Source
+from services import scheduling
+from services.ingest import ingest, ingest_many
+from services.models import Organization, Source, repository_key, slugify_source
+from systemlogs.bulk import bulk_log
 from web.shortcuts import get_object_or_None
 
 logger = logging.getLogger(__name__)
@@ -19,53 +29,168 @@ def refresh_source_from_github(source_slug):
     except FetchError as error:
         return False
 
-    for data in results:
-        form = forms.ServiceForm({"data": data["contents"]})
-        form.source = source
-        if not form.is_valid():
-            logging.error(form.errors)
-            return False
+    result = ingest(source, results)
+    if result["errors"]:
+        logging.error(result["errors"])
+        return False
+
+
+@app.task
+def refresh_batch_from_github(source_slugs):
+    """
+    Refresh all the sources together, so that dependencies between services in
+    different sources are connected in the same refresh. Each source is fetched in its
+    own task and they are all ingested together once they have been fetched.
+    """
+    logger.info(f"Task: refreshing batch of {len(source_slugs)} sources")
+    chord(fetch_source_from_github.s(slug) for slug in source_slugs)(ingest_fetched.s())
+
+
+@app.task
+def fetch_source_from_github(source_slug):
+    """
+    Fetch the files for a source, for `ingest_fetched`. Any error is logged rather than
+    raised, so that one source can't stop the rest of the batch being ingested.
+    """
+    try:
+        return [source_slug, fetch.get(Source.objects.get(slug=source_slug))]
+    except FetchError as error:
+        logger.error(f"Task: error refreshing source: {source_slug}. {error.message}")
+    except Exception:
+        logger.exception(f"Task: error refreshing source: {source_slug}")
+    return None
 
-        form.save()
+
+@app.task
+def ingest_fetched(fetched):
+    """Ingest the sources that were fetched, from a list of [source slug, results]."""
+    fetched = dict(entry for entry in fetched if entry is not None)
+    batch = [(source, fetched[source.slug]) for source in Source.objects.filter(slug__in=fetched)]
+
+    success = True
+    outcome = ingest_many(batch)
+    for source, _ in batch:
+        if outcome[source.pk]["errors"]:
+            logging.error(outcome[source.pk]["errors"])
+            success = False
+    return success
+
+
+def schedule_refresh(source_slugs):
+    """
+    Queue the refresh of the sources, in priority order and spread out so that they fit
+    within the GitHub rate limit. See `services.scheduling`.
+    """
+    for countdown, batch in scheduling.plan(scheduling.prioritise(source_slugs)):
+        logger.info(f"Task: scheduling {len(batch)} sources to refresh in {countdown}s")
+        refresh_batch_from_github.apply_async(args=[batch], countdown=countdown)
 
 
 @app.task
 def refresh_sources_from_github():
     logger.info(f"Task: refreshing sources from github")
-    for source in Source.objects.filter(active=True):
-        refresh_source_from_github.delay(source.slug)
+    schedule_refresh(list(Source.objects.filter(active=True).values_list("slug", flat=True)))
 
 
 @app.task
 def refresh_org_from_github(org_slug):
     logger.info(f"Task: refreshing org from github {org_slug}")
+    # The same repository can be returned more than once, so they are keyed by url. Only
+    # when each one was last pushed to is kept, not the whole repository.
+    pushed = {}
     try:
-        results = fetch.get_repositories(org_slug)
+        for repo in fetch.get_repositories(org_slug):
+            pushed[repo.html_url] = repo.pushed_at
     except FetchError as error:
         return False
 
-    # Results is giving the same repository multiple times, not sure why yet.
-    # So we'll dedupe.
-    dedupe = set()
-    for repo in results:
-        logger.info(f"repo {repo}")
-        # If no source exists at this url, create one.
-        slug = None
-        existing = get_object_or_None(Source, url=repo.html_url)
-        if not existing:
-            form = forms.SourceForm({"url": repo.html_url, "active": True})
-            if not form.is_valid():
-                logging.error(form.errors)
-                continue
-
-            form.save()
-            slug = form.instance.slug
-        else:
-            slug = existing.slug
-        dedupe.add(slug)
-
-    for slug in dedupe:
-        refresh_source_from_github.delay(slug)
+    org = get_object_or_None(Organization, name=org_slug)
+    changed = sync_sources(org, pushed)
+    if changed:
+        schedule_refresh(changed)
+
+
+def sync_sources(org, pushed):
+    """
+    Make the sources match the repositories in the org, passed as a dict of the url of
+    each repository to when it was last pushed to. Sources are created for new repositories
+    and deactivated for repositories that are no longer in the org, in bulk. Sources are
+    only deactivated if there is an org and at least one repository was listed. Sources
+    for the repositories that don't have an org yet are given this one.
+
+    Returns the slugs of the active sources that are new or have been pushed to since
+    they were last refreshed.
+    """
+    # Match the repositories to the sources by their repository key, so differences in
+    # case in the url don't add another source.
+    urls = {repository_key(url): url for url in pushed}
+    # No repositories at all is far more likely to be a listing that went wrong than an
+    # org that is empty, and with no org every source without one would be swept up.
+    sweep = org is not None and bool(pushed)
+    query = Q(repository__in=urls.keys())
+    if sweep:
+        query |= Q(org=org)
+    existing = {source.repository: source for source in Source.objects.filter(query)}
+
+    new = []
+    for key in urls.keys() - existing.keys():
+        url = urls[key]
+        try:
+            _, name = fetch.url_to_nwo(url)
+        except ValueError:
+            logger.error(f"Task: unable to parse the repository url: {url}")
+            continue
+        new.append(
+            Source(
+                url=url,
+                name=name,
+                slug=slugify_source(url),
+                repository=key,
+                org=org,
+                active=True,
+            )
+        )
+
+    updates = []
+    now = timezone.now()
+    for key, source in existing.items():
+        if sweep and key not in urls and source.org_id == org.pk and source.active:
+            old = copy.copy(source)
+            source.active, source.updated = False, now
+            updates.append((old, source))
+        elif org is not None and key in urls and source.org_id is None:
+            # Sources added before they were linked to an org, so they can be swept later.
+            old = copy.copy(source)
+            source.org = org
+            updates.append((old, source))
+
+    with transaction.atomic():
+        # A source could have been added since they were looked up, so skip any conflicts.
+        # Only the rows that were inserted here carry the created time set on the insert.
+        Source.objects.bulk_create(new, ignore_conflicts=True)
+        created = {source.url: source.created for source in new}
+        new = [
+            source
+            for source in Source.objects.filter(url__in=created.keys())
+            if source.created == created[source.url]
+        ]
+        Source.objects.bulk_update([source for _, source in updates], ["org", "active", "updated"])
+        bulk_log(LogEntry.Action.CREATE, [(None, source) for source in new])
+        bulk_log(LogEntry.Action.UPDATE, updates)
+
+    changed = [source.slug for source in new]
+    for key, source in existing.items():
+        if key in urls and source.active and pushed_since(pushed[urls[key]], source.updated):
+            changed.append(source.slug)
+    return changed
+
+
+def pushed_since(pushed_at, updated):
+    if pushed_at is None:
+        return True
+    if timezone.is_naive(pushed_at):
+        pushed_at = timezone.make_aware(pushed_at, datetime.timezone.utc)
+    return pushed_at > updated
 
 
 @app.task
@@ -1,20 +1,34 @@
-from unittest.mock import patch
+import json
+import tempfile
+import time
+from datetime import timedelta
+from unittest.mock import Mock, patch
 
 from auditlog.models import LogEntry
 from django.contrib import messages
+from django.core.cache import cache
+from django.db import connection
 from django.db.models.deletion import ProtectedError
 from django.forms.models import model_to_dict
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from faker import Faker
+from github import GithubException
 
-from catalog.errors import FetchError
+from catalog.errors import FetchError, NoRepository
 from catalog.tests import BaseTestCase
+from gh import limits
 from gh.fetch import url_to_nwo
+from health.models import Check, CheckResult
 from web.shortcuts import get_object_or_None
 
-from . import forms, models
+from . import forms, models, scheduling
+from .graph import get_graph
+from .ingest import ingest, ingest_many
 from .management.commands.refresh import Command
+from .tasks import refresh_org_from_github, sync_sources
 
 fake = Faker("en_US")
 
@@ -127,6 +141,46 @@ class TestServiceList(BaseTestCase):
         self.assertTemplateUsed(response, "service-list.html")
         self.assertContains(response, service.name)
 
+    def test_health_results(self):
+        """Test the list services view shows the health from the latest results."""
+        self.client.force_login(self.user)
+        service = create_service(create_source())
+        check = Check.objects.create(name=fake.name())
+        CheckResult.objects.create(health_check=check, service=service, result="fail")
+        CheckResult.objects.create(health_check=check, service=service, result="pass")
+        response = self.client.get(reverse("services:service-list"))
+        self.assertContains(response, "All health checks pass")
+
+    def test_health_results_queries(self):
+        """Test the list services view does not query per service or check."""
+        self.client.force_login(self.user)
+        source = create_source()
+        check = Check.objects.create(name=fake.name())
+        service = create_service(source)
+        CheckResult.objects.create(health_check=check, service=service, result="pass")
+        with CaptureQueriesContext(connection) as single:
+            self.client.get(reverse("services:service-list"))
+
+        for _ in range(3):
+            service = create_service(source)
+            for check in [check, Check.objects.create(name=fake.name())]:
+                CheckResult.objects.create(health_check=check, service=service, result="pass")
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse("services:service-list"))
+        self.assertEqual(len(single), len(many))
+
+    def test_health_filter(self):
+        """Test the list services view filters on the health of the service."""
+        self.client.force_login(self.user)
+        source = create_source()
+        passing, failing, not_run = [create_service(source) for _ in range(3)]
+        check = Check.objects.create(name=fake.name())
+        CheckResult.objects.create(health_check=check, service=passing, result="pass")
+        CheckResult.objects.create(health_check=check, service=failing, result="fail")
+        for state, service in [("passing", passing), ("failing", failing), ("not-run", not_run)]:
+            response = self.client.get(reverse("services:service-list"), {"health": state})
+            self.assertEqual(list(response.context["page"]), [service])
+
     def test_get_service_not_logged_in(self):
         """Test the page for viewing a service when not logged in."""
         source = create_source()
@@ -233,6 +287,178 @@ class TestDependencies(TestCase):
         self.assertEqual(result["service"].dependencies.first(), self.service_parent)
 
 
+class TestGraph(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        source = create_source()
+        # A depends on B, which depends on C, which depends back on A.
+        self.a, self.b, self.c, self.d = [create_service(source) for _ in range(4)]
+        self.a.dependencies.add(self.b)
+        self.b.dependencies.add(self.c)
+        self.c.dependencies.add(self.a)
+
+    def test_transitive(self):
+        """Follows all the hops and does not loop forever."""
+        graph = get_graph()
+        self.assertEqual(graph.transitive_dependencies(self.a.pk), {self.b.pk: 1, self.c.pk: 2})
+        self.assertEqual(graph.transitive_dependents(self.a.pk), {self.c.pk: 1, self.b.pk: 2})
+        self.assertEqual(graph.transitive_dependencies(self.d.pk), {})
+        self.assertEqual(graph.depth(self.a.pk), 2)
+        self.assertEqual(graph.depth(self.d.pk), 0)
+
+    def test_path(self):
+        """Finds the shortest path, if there is one."""
+        graph = get_graph()
+        self.assertEqual(graph.path(self.a.pk, self.c.pk), [self.a.pk, self.b.pk, self.c.pk])
+        self.assertEqual(graph.path(self.a.pk, self.d.pk), None)
+
+    def test_invalidated(self):
+        """Changing the dependencies means the graph gets loaded again."""
+        self.assertEqual(get_graph().transitive_dependents(self.d.pk), {})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.c.dependencies.add(self.d)
+            # Not until the change is committed.
+            self.assertEqual(get_graph().transitive_dependents(self.d.pk), {})
+        self.assertEqual(len(get_graph().transitive_dependents(self.d.pk)), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.c.delete()
+        self.assertEqual(get_graph().transitive_dependents(self.d.pk), {})
+
+    def test_cached(self):
+        """The graph is only loaded once."""
+        get_graph()
+        with self.assertNumQueries(0):
+            get_graph()
+
+    def test_detail(self):
+        """The detail page shows the impact of the service."""
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("services:service-detail", args=[self.d.slug]))
+        self.assertEqual(
+            response.context["impact"], {"dependencies": 0, "dependents": 0, "depth": 0}
+        )
+
+    def test_api(self):
+        """The API returns the dependencies, dependents and a path."""
+        self.api_login()
+        url = reverse("services:api-service-graph", args=[self.a.pk])
+        response = self.api_client.get(url, {"to": self.c.pk}).json()
+        self.assertEqual([d["slug"] for d in response["dependencies"]], [self.b.slug, self.c.slug])
+        self.assertEqual([d["slug"] for d in response["dependents"]], [self.c.slug, self.b.slug])
+        self.assertEqual(response["path"], [self.a.slug, self.b.slug, self.c.slug])
+        self.assertEqual(response["depth"], 2)
+
+    def test_api_invalid_to(self):
+        """A path to something that isn't a service id is a bad request."""
+        self.api_login()
+        url = reverse("services:api-service-graph", args=[self.a.pk])
+        self.assertEqual(self.api_client.get(url, {"to": "nope"}).status_code, 400)
+
+    def test_api_unauth(self):
+        url = reverse("services:api-service-graph", args=[self.a.pk])
+        self.assertEqual(self.api_client.get(url).status_code, 401)
+
+
+class TestIngest(TestCase):
+    def setUp(self):
+        self.source = create_source()
+
+    def get_results(self, count):
+        names = [fake.unique.user_name() for _ in range(count)]
+        return [
+            {
+                "path": f"{name}.json",
+                "contents": {
+                    "name": name,
+                    "description": fake.text(),
+                    "priority": 1,
+                    # Each service depends on the next one.
+                    "dependencies": names[index + 1 : index + 2],
+                },
+            }
+            for index, name in enumerate(names)
+        ]
+
+    def test_ingest(self):
+        """Creates all the services and connects them, even to services in later files."""
+        result = ingest(self.source, self.get_results(3))
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(len(result["created"]), 3)
+        first, second, third = result["services"]
+        self.assertEqual(list(first.dependencies.all()), [second])
+        self.assertEqual(list(second.dependencies.all()), [third])
+        for service in result["services"]:
+            self.assertEqual(LogEntry.objects.get_for_object(service).count(), 1)
+            self.assertEqual(service.path, f"{service.name}.json")
+
+    def test_ingest_schedules(self):
+        """New services are scheduled for the checks that run against all services."""
+        check = Check.objects.create(name=fake.name())
+        result = ingest(self.source, self.get_results(3))
+        self.assertEqual(
+            set(check.schedules.values_list("service", flat=True)),
+            {service.pk for service in result["services"]},
+        )
+
+    def test_ingest_updates(self):
+        """Updates services that changed and removes old dependencies."""
+        results = self.get_results(2)
+        ingest(self.source, results)
+        results[0]["contents"]["description"] = "changed"
+        results[0]["contents"]["dependencies"] = []
+        result = ingest(self.source, results)
+        self.assertEqual(result["created"], [])
+        self.assertEqual([s.name for s in result["updated"]], [results[0]["contents"]["name"]])
+        self.assertEqual(result["services"][0].dependencies.count(), 0)
+        self.assertIn("Removed dependency", result["logs"][-1][0])
+
+    def test_ingest_invalid(self):
+        """Nothing is saved if any of the files are invalid."""
+        results = self.get_results(2)
+        del results[1]["contents"]["priority"]
+        result = ingest(self.source, results)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertEqual(models.Service.objects.count(), 0)
+
+    def test_ingest_queries(self):
+        """The number of queries does not grow with the number of services."""
+        with CaptureQueriesContext(connection) as few:
+            ingest(self.source, self.get_results(2))
+        with CaptureQueriesContext(connection) as many:
+            ingest(self.source, self.get_results(10))
+        self.assertEqual(len(few), len(many))
+
+    def test_ingest_many(self):
+        """Connects dependencies on services in a source that comes later in the batch."""
+        other = create_source()
+        first, second = self.get_results(1), self.get_results(1)
+        first[0]["contents"]["dependencies"] = [second[0]["contents"]["name"]]
+        outcome = ingest_many([(self.source, first), (other, second)])
+        service = outcome[self.source.pk]["services"][0]
+        dependency = outcome[other.pk]["services"][0]
+        self.assertEqual(list(service.dependencies.all()), [dependency])
+        self.assertEqual(dependency.source, other)
+
+    def test_ingest_waiting(self):
+        """Services ingested earlier are connected to dependencies created later."""
+        other = create_source()
+        first, second = self.get_results(1), self.get_results(1)
+        first[0]["contents"]["dependencies"] = [second[0]["contents"]["name"]]
+        service = ingest(self.source, first)["services"][0]
+        self.assertEqual(service.dependencies.count(), 0)
+        dependency = ingest(other, second)["services"][0]
+        self.assertEqual(list(service.dependencies.all()), [dependency])
+
+    def test_ingest_many_invalid(self):
+        """A source with an invalid file is skipped, but the others are not."""
+        other = create_source()
+        invalid = self.get_results(1)
+        del invalid[0]["contents"]["priority"]
+        outcome = ingest_many([(self.source, invalid), (other, self.get_results(1))])
+        self.assertEqual(len(outcome[self.source.pk]["errors"]), 1)
+        self.assertEqual(models.Service.objects.get().source, other)
+
+
 class TestSchema(BaseTestCase):
     def test_schema(self):
         """Test the list schema view."""
@@ -246,6 +472,38 @@ class TestSchema(BaseTestCase):
         response = self.client.get(reverse("services:schema-detail"))
         self.assertEqual(response.status_code, 302)
 
+    def test_validator_cached(self):
+        """The validator is only rebuilt when the schema file changes."""
+        validator = forms.get_validator()
+        self.assertIs(forms.get_validator(), validator)
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as schema_file:
+            json.dump({"type": "object", "required": ["name"]}, schema_file)
+            schema_file.flush()
+            with self.settings(SERVICE_SCHEMA=schema_file.name):
+                self.assertIsNot(forms.get_validator(), validator)
+                self.assertEqual(forms.validate_data({}), "'name' is a required property")
+        self.assertIsNone(forms.validate_data(sample_response()[0]["contents"]))
+
+    def test_api_validate(self):
+        """Validates all the documents and returns every failure."""
+        self.api_login()
+        documents = [sample_response()[0]["contents"], {"hi": "there"}, {"name": "foo"}]
+        url = reverse("services:api-schema-validate")
+        response = self.api_client.post(url, {"documents": documents}, format="json").json()
+        self.assertFalse(response["success"])
+        self.assertEqual([failure["index"] for failure in response["failures"]], [1, 2])
+
+    def test_api_validate_not_object(self):
+        """A body that isn't an object is a bad request."""
+        self.api_login()
+        url = reverse("services:api-schema-validate")
+        for body in [[{"name": "foo"}], "foo", 1]:
+            self.assertEqual(self.api_client.post(url, body, format="json").status_code, 400)
+
+    def test_api_validate_unauth(self):
+        url = reverse("services:api-schema-validate")
+        self.assertEqual(self.api_client.post(url, {"documents": []}).status_code, 401)
+
 
 class TestValidate(BaseTestCase):
     def setUp(self):
@@ -535,6 +793,22 @@ class TestManagementRefresh(BaseTestCase):
         self.assertEquals(models.Service.objects.all().count(), 1)
         self.assertEquals(mock_fetch.get.call_count, 2)
 
+    @patch("services.tasks.fetch")
+    def test_refresh_error(self, mock_fetch):
+        """An error fetching one source doesn't stop the others being ingested."""
+        broken, working = create_source(), create_source()
+
+        def get(source):
+            if source == broken:
+                raise GithubException(502, "Bad gateway", {})
+            return sample_response()
+
+        mock_fetch.get.side_effect = get
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True):
+            self.command.handle(all=True, quiet=True)
+        self.assertEquals(mock_fetch.get.call_count, 2)
+        self.assertEquals(models.Service.objects.get().source, working)
+
     @patch("services.tasks.fetch")
     def test_refresh_some(self, mock_fetch):
         """Test refreshes some"""
@@ -560,6 +834,173 @@ class TestManagementRefresh(BaseTestCase):
         self.assertEquals(mock_fetch.get.call_count, 0)
 
 
+class TestOrgRefresh(TestCase):
+    def setUp(self):
+        self.org = models.Organization.objects.create(url="https://github.com/andy")
+        self.source = create_source()
+        self.source.org = self.org
+        self.source.save()
+
+    def repo(self, url, pushed_at=None):
+        return Mock(html_url=url, pushed_at=pushed_at or timezone.now())
+
+    @patch("services.tasks.refresh_batch_from_github")
+    @patch("services.tasks.fetch.get_repositories")
+    def test_refresh_org(self, mock_repos, mock_refresh):
+        """New repositories are added, removed ones deactivated and changed ones refreshed."""
+        old = create_source()
+        url = "https://github.com/andy/new"
+        mock_repos.return_value = iter([self.repo(url), self.repo(url), self.repo(old.url)])
+        refresh_org_from_github(self.org.name)
+
+        new = models.Source.objects.get(url=url)
+        self.assertEqual((new.name, new.slug, new.org), ("new", "andy-new", self.org))
+        self.assertEqual(new.repository, "andy/new")
+        self.assertEqual(LogEntry.objects.get_for_object(new).count(), 1)
+        self.source.refresh_from_db()
+        self.assertFalse(self.source.active)
+        # One chunk for each org.
+        self.assertEqual(mock_refresh.apply_async.call_count, 2)
+        slugs = [call.kwargs["args"][0] for call in mock_refresh.apply_async.call_args_list]
+        self.assertEqual({slug for chunk in slugs for slug in chunk}, {new.slug, old.slug})
+
+    @patch("services.tasks.refresh_batch_from_github")
+    @patch("services.tasks.fetch.get_repositories")
+    def test_refresh_org_not_listed(self, mock_repos, mock_refresh):
+        """Sources are not deactivated if the repositories could not be listed."""
+        mock_repos.side_effect = NoRepository("Not installed")
+        self.assertFalse(refresh_org_from_github(self.org.name))
+        mock_repos.side_effect, mock_repos.return_value = None, iter([])
+        refresh_org_from_github(self.org.name)
+        self.assertTrue(models.Source.objects.get(pk=self.source.pk).active)
+
+    def test_sync_sources_no_org(self):
+        """Without an org, sources without an org are not deactivated."""
+        source = create_source()
+        sync_sources(None, {"https://github.com/andy/new": timezone.now()})
+        self.assertTrue(models.Source.objects.get(pk=source.pk).active)
+        self.assertTrue(models.Source.objects.filter(url="https://github.com/andy/new").exists())
+
+    def test_sync_sources_adopted(self):
+        """Sources without an org are given the org they are listed in."""
+        source = create_source()
+        sync_sources(self.org, {source.url: timezone.now()})
+        source.refresh_from_db()
+        self.assertEqual(source.org, self.org)
+        self.assertTrue(source.active)
+        log = LogEntry.objects.get_for_object(source).first()
+        self.assertEqual(log.action, LogEntry.Action.UPDATE)
+
+    @patch("services.tasks.fetch.url_to_nwo")
+    def test_sync_sources_added_meanwhile(self, mock_nwo):
+        """A source added by someone else before the insert isn't counted as created."""
+        url = "https://github.com/andy/new"
+
+        def add_source(url):
+            forms.SourceForm({"url": url, "active": True}).save()
+            return "andy", "new"
+
+        mock_nwo.side_effect = add_source
+        self.assertEqual(sync_sources(None, {url: timezone.now()}), [])
+        logs = LogEntry.objects.get_for_object(models.Source.objects.get(url=url))
+        self.assertEqual(logs.filter(action=LogEntry.Action.CREATE).count(), 1)
+
+    def test_sync_sources_updated(self):
+        """Deactivating a source changes when it was updated."""
+        updated = self.source.updated
+        sync_sources(self.org, {"https://github.com/andy/new": timezone.now()})
+        self.source.refresh_from_db()
+        self.assertFalse(self.source.active)
+        self.assertGreater(self.source.updated, updated)
+
+    @patch("services.tasks.refresh_batch_from_github")
+    @patch("services.tasks.fetch.get_repositories")
+    def test_refresh_org_unchanged(self, mock_repos, mock_refresh):
+        """Sources that have not been pushed to since they were refreshed are skipped."""
+        pushed_at = timezone.now() - timedelta(days=1)
+        mock_repos.return_value = iter([self.repo(self.source.url, pushed_at)])
+        refresh_org_from_github(self.org.name)
+        self.assertTrue(models.Source.objects.get(pk=self.source.pk).active)
+        mock_refresh.apply_async.assert_not_called()
+
+    @patch("services.tasks.refresh_batch_from_github")
+    @patch("services.tasks.fetch.get_repositories")
+    def test_refresh_org_case(self, mock_repos, mock_refresh):
+        """A repository that differs from a source only in case is the same source."""
+        pushed_at = timezone.now() - timedelta(days=1)
+        mock_repos.return_value = iter([self.repo(self.source.url.upper(), pushed_at)])
+        refresh_org_from_github(self.org.name)
+        self.assertEqual(models.Source.objects.count(), 1)
+        self.assertTrue(models.Source.objects.get(pk=self.source.pk).active)
+
+
+class TestScheduling(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_prioritise(self):
+        """Sources with higher priority services come first, then the least recently updated."""
+        low, high, stale, empty = [create_source() for _ in range(4)]
+        for source, priority in [(low, 5), (high, 1), (stale, 5)]:
+            service = create_service(source)
+            service.priority = priority
+            service.save()
+        models.Source.objects.filter(pk=stale.pk).update(updated=timezone.now() - timedelta(1))
+        slugs = [source.slug for source in (low, high, stale, empty)]
+        ordered = [source.slug for source in scheduling.prioritise(slugs)]
+        self.assertEqual(ordered, [empty.slug, high.slug, stale.slug, low.slug])
+
+    def test_plan(self):
+        """Sources that don't fit wait for the rate limit to reset, up to a window from now."""
+        sources = [models.Source(url=f"https://github.com/andy/{i}", slug=str(i)) for i in range(5)]
+        reset = int(time.time()) + 100
+        # A fifth of the limit is kept back, so there's room for one source now and two in
+        # each window after that.
+        budget = {"remaining": 3000, "limit": 5000, "reset": reset}
+        cache.set(limits.budget_key("andy"), budget)
+        with patch.object(scheduling, "requests_per_source", 2000):
+            batches = scheduling.plan(sources)
+        self.assertEqual(batches[0], (0, ["0"]))
+        self.assertEqual([slugs for _, slugs in batches[1:]], [["1", "2"]])
+        self.assertAlmostEqual(batches[1][0], 100, delta=2)
+
+    def test_plan_capped(self):
+        """Nothing is planned further out than a window, the next refresh picks it up."""
+        sources = [
+            models.Source(url=f"https://github.com/andy/{i}", slug=str(i)) for i in range(40)
+        ]
+        budget = {"remaining": 0, "limit": 5000, "reset": int(time.time()) + 600}
+        cache.set(limits.budget_key("andy"), budget)
+        with patch.object(scheduling, "requests_per_source", 200):
+            batches = scheduling.plan(sources)
+        # A fifth of the limit is kept back, leaving room for twenty sources a window.
+        self.assertEqual(sum(len(slugs) for _, slugs in batches), 20)
+        self.assertAlmostEqual(batches[0][0], 600, delta=2)
+        self.assertLess(max(countdown for countdown, _ in batches), limits.window)
+
+    def test_plan_chunks(self):
+        """The sources that fit now are split into chunks, spread over the window."""
+        sources = [models.Source(url=f"https://github.com/andy/{i}", slug=str(i)) for i in range(5)]
+        budget = {"remaining": 5000, "limit": 5000, "reset": int(time.time()) + 300}
+        cache.set(limits.budget_key("andy"), budget)
+        with patch.object(scheduling, "chunk_size", 2):
+            batches = scheduling.plan(sources)
+        self.assertEqual([slugs for _, slugs in batches], [["0", "1"], ["2", "3"], ["4"]])
+        self.assertEqual(batches[0][0], 0)
+        self.assertAlmostEqual(batches[1][0], 100, delta=2)
+        self.assertAlmostEqual(batches[2][0], 200, delta=2)
+
+    def test_plan_reserved(self):
+        """Sources planned by another refresh are taken off what's left of the window."""
+        budget = {"remaining": 3000, "limit": 5000, "reset": int(time.time()) + 100}
+        cache.set(limits.budget_key("andy"), budget)
+        with patch.object(scheduling, "requests_per_source", 2000):
+            first = scheduling.plan([models.Source(url="https://github.com/andy/a", slug="a")])
+            second = scheduling.plan([models.Source(url="https://github.com/andy/b", slug="b")])
+        self.assertEqual(first, [(0, ["a"])])
+        self.assertAlmostEqual(second[0][0], 100, delta=2)
+
+
 class TestServiceForm(BaseTestCase):
     def setUp(self):
         super().setUp()
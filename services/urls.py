@@ -25,7 +25,9 @@ urlpatterns = [
     path("org/<str:slug>/detail/", views.org_detail, name="org-detail"),
     path("org/refresh/", views.org_refresh, name="org-refresh"),
     path("api/", include(router.urls)),
+    path("api/services/<pk>/graph/", views.api_service_graph, name="api-service-graph"),
     path("api/sources/<pk>/refresh/", views.api_source_refresh, name="api-source-refresh"),
     path("api/sources/<pk>/validate/", views.api_source_validate, name="api-source-validate"),
     path("api/services/schema/", views.api_schema_detail, name="api-schema-detail"),
+    path("api/services/validate/", views.api_schema_validate, name="api-schema-validate"),
 ]
@@ -7,7 +7,7 @@ from auditlog.models import LogEntry
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
-from django.db.models import CharField, Value
+from django.db.models import CharField, Q, Value
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 from django.views.decorators.http import require_POST
@@ -19,9 +19,12 @@ from rest_framework.response import Response
 from catalog.errors import FetchError, FileAlreadyExists
 from events.models import Event
 from gh import create, fetch
+from health.models import HEALTH_CHOICES
 from web.helpers import YES_NO_CHOICES, paginate
 
-from .forms import OrgForm, ServiceForm, SourceForm, get_schema
+from .forms import OrgForm, ServiceForm, SourceForm, get_schema, validate_data
+from .graph import get_graph
+from .ingest import ingest
 from .models import Organization, Service, Source
 from .serializers import ServiceSerializer, SourceSerializer
 from .tasks import refresh_orgs_from_github
@@ -29,19 +32,27 @@ from .tasks import refresh_orgs_from_github
 
 class ServiceFilter(django_filters.FilterSet):
     active = django_filters.TypedChoiceFilter(choices=YES_NO_CHOICES, coerce=strtobool)
+    health = django_filters.ChoiceFilter(choices=HEALTH_CHOICES, method="filter_health")
 
     class Meta:
         model = Service
         fields = ["priority", "source__slug"]
 
+    def filter_health(self, queryset, name, value):
+        # Services without a summary have not had any checks run yet.
+        if value == "not-run":
+            return queryset.filter(Q(health__state=value) | Q(health__isnull=True))
+        return queryset.filter(health__state=value)
+
 
 def service_list(request):
-    queryset = Service.objects.all().order_by("priority", "name")
+    queryset = Service.objects.select_related("health").order_by("priority", "name")
     services = ServiceFilter(request.GET, queryset=queryset)
     context = paginate(request, services)
     context.update(
         {
             "priorities": [str(k) for k in range(1, 11)],
+            "health": dict(HEALTH_CHOICES).keys(),
         }
     )
     return render(request, "service-list.html", context)
@@ -57,7 +68,7 @@ def service_delete(request, slug):
 
 
 def service_detail(request, slug):
-    service = get_object_or_404(slug=slug, klass=Service)
+    service = get_object_or_404(slug=slug, klass=Service.objects.select_related("health"))
     context = {
         "service": service,
         "source": service.source,
@@ -72,6 +83,7 @@ def service_detail(request, slug):
             )
         ),
         "checks": service.latest_results(),
+        "impact": impact(service),
         "log": LogEntry.objects.get_for_object(service).order_by("-timestamp").first(),
         "events": Event.objects.filter(services__in=[service], start__gt=timezone.now()).order_by(
             "start"
@@ -82,6 +94,56 @@ def service_detail(request, slug):
     return render(request, "service-detail.html", context)
 
 
+def impact(service):
+    graph = get_graph()
+    return {
+        "dependencies": len(graph.transitive_dependencies(service.pk)),
+        "dependents": len(graph.transitive_dependents(service.pk)),
+        "depth": graph.depth(service.pk),
+    }
+
+
+@api_view(["GET"])
+def api_service_graph(request, pk):
+    """
+    All the services this service depends on and that depend on it, following every hop.
+    Pass `to` as the pk of another service to get the shortest path to it.
+    """
+    service = get_object_or_404(pk=pk, klass=Service)
+    graph = get_graph()
+    dependencies = graph.transitive_dependencies(service.pk)
+    dependents = graph.transitive_dependents(service.pk)
+    slugs = dict(
+        Service.objects.filter(pk__in=set(dependencies) | set(dependents)).values_list("pk", "slug")
+    )
+
+    def as_list(distances):
+        return [
+            {"id": pk, "slug": slugs[pk], "distance": distance}
+            for pk, distance in sorted(distances.items(), key=lambda item: item[1])
+        ]
+
+    response = {
+        "service": service.slug,
+        "depth": graph.depth(service.pk),
+        "dependencies": as_list(dependencies),
+        "dependents": as_list(dependents),
+    }
+    if request.GET.get("to"):
+        if not request.GET["to"].isdigit():
+            return Response(
+                {"success": False, "error": "`to` must be the id of a service."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        end = get_object_or_404(pk=request.GET["to"], klass=Service)
+        path = graph.path(service.pk, end.pk)
+        # Everything on the path is a dependency, apart from the service itself.
+        slugs[service.pk] = service.slug
+        response["path"] = [slugs[pk] for pk in path] if path is not None else None
+
+    return Response(response)
+
+
 def source_list(request):
     queryset = Source.objects.filter().order_by("url")
     context = paginate(request, queryset)
@@ -143,20 +205,13 @@ def api_source_refresh(request, pk):
 def refresh_results(results, source, request):
     """
     A helper that takes the list of results from gh fetch and runs
-    them through the service form, logging any output.
+    them through the ingestion, logging any output.
 
     Should we do this in background? Maybe, but it gives direct feedback to the user, so going to leave it for now.
     """
-    for data in results:
-        form = ServiceForm({"data": data["contents"]})
-        form.source = source
-        if form.is_valid():
-            form.save()
-            source.updated = timezone.now()
-            source.save()
-        else:
-            messages.error(request, f"Refresh error on `{source.slug}`: {form.nice_errors()}.")
-            break
+    result = ingest(source, results)
+    for error in result["errors"]:
+        messages.error(request, f"Refresh error on `{source.slug}`: {error}.")
 
     messages.info(request, f"Refreshed source `{source.slug}` successfully.")
 
@@ -288,6 +343,28 @@ def api_schema_detail(request):
     )
 
 
+@api_view(["POST"])
+def api_schema_validate(request):
+    """
+    Validate a list of catalog documents against the schema, passed as `documents`.
+    Every document is validated, not just up to the first failure.
+    """
+    documents = request.data.get("documents") if isinstance(request.data, dict) else None
+    if not isinstance(documents, list):
+        return Response(
+            {"success": False, "error": "`documents` must be a list."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    failures = []
+    for index, document in enumerate(documents):
+        error = validate_data(document)
+        if error:
+            failures.append({"index": index, "error": error})
+
+    return Response({"success": not failures, "failures": failures})
+
+
 def org_detail(request, slug):
     org = get_object_or_404(name=slug, klass=Organization)
     if request.method == "POST":
@@ -313,6 +390,6 @@ class ServiceViewSet(
     mixins.DestroyModelMixin,
     viewsets.GenericViewSet,
 ):
-    queryset = Service.objects.all().order_by("-created")
+    queryset = Service.objects.select_related("health").order_by("-created")
     serializer_class = ServiceSerializer
     permission_classes = [permissions.DjangoModelPermissions]
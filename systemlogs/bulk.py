@@ -0,0 +1,41 @@
+import json
+
+from auditlog.diff import model_instance_diff
+from auditlog.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import pre_save
+from django.utils.encoding import smart_str
+
+
+def bulk_log(action, changes):
+    """
+    Write the log entries for objects that were created, updated or deleted in bulk,
+    since the bulk queries skip the signals the audit log relies on.
+
+    Changes is a list of (old, new) instances, where old is None for a create and new
+    is None for a delete. Updates that didn't change anything are not logged.
+    """
+    entries = []
+    for old, new in changes:
+        instance = new if new is not None else old
+        # Only check the fields on the model itself, otherwise reverse relations such as
+        # a one to one get looked up for every instance.
+        fields = [field.name for field in instance._meta.concrete_fields]
+        diff = model_instance_diff(old, new, fields_to_check=fields)
+        if action == LogEntry.Action.UPDATE and not diff:
+            continue
+
+        entry = LogEntry(
+            content_type=ContentType.objects.get_for_model(instance),
+            object_pk=smart_str(instance.pk),
+            object_id=instance.pk,
+            object_repr=smart_str(instance),
+            action=action,
+            changes=json.dumps(diff),
+        )
+        # This lets the audit log middleware set the actor and address as it would for
+        # an entry that was saved normally.
+        pre_save.send(sender=LogEntry, instance=entry, raw=False, using=None, update_fields=None)
+        entries.append(entry)
+
+    return LogEntry.objects.bulk_create(entries)
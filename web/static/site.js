@@ -62,7 +62,7 @@ function processCreateAppForm(createAppForm) {
         organization_administration: "read",
         pull_requests: "write"
       },
-      default_events: ["deployment", "release"],
+      default_events: ["deployment", "push", "release"],
     });
     let manifestField = createAppForm.querySelector("[name=manifest]");
     manifestField.value = manifest;
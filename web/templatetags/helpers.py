@@ -55,35 +55,14 @@ def markdown_filter(text):
     return mark_safe(md.convert(text))
 
 
-@register.simple_tag(name="checks_badge")
-def checks_badge(checks):
-    result = {
-        "colour": "dark",
-        "text": "No health checks run",
+@register.simple_tag(name="health_badge")
+def health_badge(state):
+    badges = {
+        "passing": {"colour": "success", "text": "All health checks pass"},
+        "failing": {"colour": "warning", "text": "Some checks failing"},
     }
-
-    not_run = True
-    all_passing = True
-    for check in checks:
-        if check["last"] is None:
-            all_passing = False
-            continue
-        not_run = False
-        if check["last"].result != "pass":
-            all_passing = False
-            break
-
-    if not_run:
-        result["colour"] = "secondary"
-        result["text"] = "No health checks run"
-    elif all_passing:
-        result["text"] = "All health checks pass"
-        result["colour"] = "success"
-    else:
-        result["colour"] = "warning"
-        result["text"] = "Some checks failing"
-
-    return result
+    # Services that have no summary yet haven't had any checks run.
+    return badges.get(state, {"colour": "secondary", "text": "No health checks run"})
 
 
 @register.filter(name="dict_key")
@@ -13,6 +13,7 @@ from faker import Faker
 from rest_framework.authtoken.models import Token
 
 from catalog.tests import BaseTestCase
+from health.models import health_state
 from services.models import Organization
 from user_profile.models import Profile
 
@@ -21,7 +22,7 @@ from .middleware import CatalogMiddleware, TimezoneMiddleware
 from .signals import user_logged_in_handler
 from .templatetags.helpers import (
     apply_format,
-    checks_badge,
+    health_badge,
     markdown_filter,
     priority_as_colour,
     yesno_if_boolean,
@@ -300,27 +301,32 @@ class FakeResult:
         self.result = result
 
 
-class TestChecksBadge(TestCase):
+class TestHealthBadge(TestCase):
     def test_all_checks_pass(self):
         checks = [{"last": FakeResult("pass")}]
         self.assertEqual(
-            checks_badge(checks), {"colour": "success", "text": "All health checks pass"}
+            health_badge(health_state(checks)),
+            {"colour": "success", "text": "All health checks pass"},
         )
 
         checks.append({"last": FakeResult("pass")})
         self.assertEqual(
-            checks_badge(checks), {"colour": "success", "text": "All health checks pass"}
+            health_badge(health_state(checks)),
+            {"colour": "success", "text": "All health checks pass"},
         )
 
     def test_all_no_checks_pass(self):
         checks = []
         self.assertEqual(
-            checks_badge(checks), {"colour": "secondary", "text": "No health checks run"}
+            health_badge(health_state(checks)),
+            {"colour": "secondary", "text": "No health checks run"},
         )
 
     def test_some_checks_fail(self):
         checks = [{"last": FakeResult("fail")}]
-        self.assertEqual(checks_badge(checks), {"colour": "warning", "text": "Some checks failing"})
+        self.assertEqual(
+            health_badge(health_state(checks)), {"colour": "warning", "text": "Some checks failing"}
+        )
 
 
 class TestGroupAssignment(TestCase):